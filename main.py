@@ -8,7 +8,7 @@ from src.pipelines.export import export_corpus_dataset
 from src.clients.scp_transfer import FileTransfer
 from src.clients.database import Database
 
-from src.models.file import AudioFormat
+from src.models.file import AudioFormat, SegmentFormat
 
 app = typer.Typer(
     no_args_is_help=True,
@@ -22,7 +22,9 @@ DATA_PATH = Path("./data/")
 def export(
     corpus_id: int = typer.Option(..., help="Corpus ID"),
     output_folder: Path = typer.Option(DATA_PATH / "export", help="Output folder"),
-    csv: bool = typer.Option(False, help="Export to CSV"),
+    csv: bool = typer.Option(
+        False, help="Export audios to CSV and segments to a partitioned Parquet dataset"
+    ),
     json_metadata: bool = typer.Option(False, help="Export to JSON metadata"),
     textgrid: bool = typer.Option(False, help="Export to TextGrid"),
     continuous_text: bool = typer.Option(False, help="Export to continuous text"),
@@ -38,7 +40,33 @@ def export(
         None, help="Filter audios by format"
     ),
     sample_rate: int = typer.Option(48000, help="Sample rate"),
+    copy_original_format: bool = typer.Option(
+        False,
+        help="Copy the original audio file when its format is one of the export formats, instead of re-encoding it at the sample rate",
+    ),
+    webdataset: bool = typer.Option(
+        False, help="Pack the segment audios and texts into WebDataset tar shards"
+    ),
+    segments_folder: Path = typer.Option(
+        DATA_PATH, help="Folder with the segments written by the transcribe command"
+    ),
+    shard_size_mb: int = typer.Option(1024, help="Size of each WebDataset shard in MB"),
+    segment_clips: bool = typer.Option(
+        False, help="Cut the segment clips out of the original audios using the database timestamps"
+    ),
+    segment_clip_format: SegmentFormat = typer.Option(
+        SegmentFormat.WAV, help="Format of the segment clips"
+    ),
     all: bool = typer.Option(False, help="Export all"),
+    workers: int = typer.Option(
+        1, help="Number of processes exporting the text files and threads encoding audios (at least 2)"
+    ),
+    audios_per_batch: int = typer.Option(
+        200, help="Number of audios whose segments are read from the database at a time"
+    ),
+    full_export: bool = typer.Option(
+        False, help="Ignore the export manifest and export every artifact again"
+    ),
     debug: bool = typer.Option(False, help="Debug mode"),
 ):
     if all:
@@ -64,6 +92,15 @@ def export(
             export_speakers_text=speakers_text,
             export_text_grid=textgrid,
             export_to_csv=csv,
+            copy_original_format=copy_original_format,
+            export_webdataset=webdataset,
+            segments_folder=segments_folder,
+            shard_size_mb=shard_size_mb,
+            export_segment_clips=segment_clips,
+            segment_clip_format=segment_clip_format,
+            workers=workers,
+            audios_per_batch=audios_per_batch,
+            full_export=full_export,
             debug=debug,
         )
 
@@ -82,6 +119,9 @@ def transcribe(
     format_filter: Optional[AudioFormat] = typer.Option(
         None, help="Filter audios by format"
     ),
+    segment_format: SegmentFormat = typer.Option(
+        SegmentFormat.WAV, help="Format of the segment audio files"
+    ),
     save_to_db: bool = typer.Option(False, help="Save transcriptions to database"),
     save_to_drive: bool = typer.Option(
         False, help="Save transcriptions to Google Drive"
@@ -108,6 +148,7 @@ def transcribe(
                 db=db if save_to_db else None,
                 storage_output_folder_id=storage_output_folder_id,
                 format_filter=format_filter,
+                segment_format=segment_format,
                 file_transfer_client=ft if transfer_to_server else None,
                 save_to_drive=save_to_drive,
                 get_db_search_key=get_db_search_key,
@@ -0,0 +1,73 @@
+"""
+Compares the silence trimming of `src.utils.silence.trim_silence` with
+`librosa.effects.trim`, which the AudioLoaderService used before, checking
+that both find the same non silent interval on synthetic recordings.
+
+Run from the repository root with:
+    poetry run python -m scripts.benchmark_trim --minutes 60 --cases 200
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+
+from src.utils.silence import trim_silence
+
+SAMPLE_RATE = 16000
+
+
+def synthetic_recording(
+    rng: np.random.Generator, n_samples: int, stereo: bool = False
+) -> np.ndarray:
+    # Low noise floor with a louder speech-like burst somewhere in the middle.
+    y = (rng.standard_normal(n_samples) * 0.001).astype(np.float32)
+    start, end = np.sort(rng.integers(0, n_samples, size=2))
+    y[start:end] += (
+        rng.standard_normal(end - start) * rng.uniform(0.0, 0.5)
+    ).astype(np.float32)
+    if stereo:
+        # Same layout as AudioLoaderService.decode: a (channels, samples) view.
+        y = np.stack([y, 0.3 * y[::-1]], axis=1).T
+    return y
+
+
+def check_equivalence(cases: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    for case in range(cases):
+        y = synthetic_recording(
+            rng, int(rng.integers(1, 60 * SAMPLE_RATE)), stereo=case % 3 == 0
+        )
+        _, expected = librosa.effects.trim(y, top_db=20)
+        result = trim_silence(y, top_db=20)
+        assert np.array_equal(
+            expected, result.non_silent_interval
+        ), f"Case {case}: librosa found {expected}, got {result.non_silent_interval}"
+    print(f"Same interval as librosa on {cases} recordings")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--cases", type=int, default=200)
+    args = parser.parse_args()
+
+    check_equivalence(args.cases)
+
+    rng = np.random.default_rng(1)
+    y = synthetic_recording(rng, args.minutes * 60 * SAMPLE_RATE)
+
+    start = time.perf_counter()
+    result = trim_silence(y, top_db=20)
+    vectorized_seconds = time.perf_counter() - start
+    print(
+        f"trim_silence: {vectorized_seconds:.2f}s (peak {result.peak:.3f}, rms {result.rms:.3f})"
+    )
+
+    start = time.perf_counter()
+    _, expected = librosa.effects.trim(y, top_db=20)
+    librosa_seconds = time.perf_counter() - start
+    print(f"librosa.effects.trim: {librosa_seconds:.2f}s")
+
+    assert np.array_equal(expected, result.non_silent_interval), "Intervals differ"
+    print(f"Same interval, {librosa_seconds / vectorized_seconds:.1f}x faster")
@@ -29,11 +29,17 @@ logger.setLevel(level=DEBUG)
 
 
 def analyze_differences_in_durations(
+    corpus_id: int,
     folders_to_explore,
     format: AudioFormat,
     get_db_search_key: Callable[..., str] = lambda x: x,
 ):
     with Database() as db:
+        corpus_audios = db.get_audios_by_corpus_id(corpus_id)
+        if not isinstance(corpus_audios, DataFrame):
+            corpus_audios = DataFrame(columns=["id", "name", "duration"])
+        audio_names = corpus_audios["name"].fillna("").str.casefold()
+
         logger.info(f"Stablishing Google Drive connection")
         google_drive_service = GoogleDriveClient()
 
@@ -57,7 +63,9 @@ def analyze_differences_in_durations(
                     .replace("_sem_cabeçalho", "")
                 )
 
-                audios_with_name = db.get_audios_by_name(get_db_search_key(audio_name))
+                audios_with_name = corpus_audios[
+                    audio_names.str.startswith(get_db_search_key(audio_name).casefold())
+                ]
                 if (
                     isinstance(audios_with_name, DataFrame)
                     and not audios_with_name.empty
@@ -127,4 +135,4 @@ if __name__ == "__main__":
     }
     format = AudioFormat.WAV
 
-    analyze_differences_in_durations(folders_to_explore, format)
+    analyze_differences_in_durations(CORPUS_ID, folders_to_explore, format)
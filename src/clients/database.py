@@ -1,13 +1,41 @@
 import pandas as pd
+import pyarrow as pa
 import pymysql
 import logging
 import sshtunnel
-from typing import List
+from pymysql.constants import FIELD_TYPE
+from typing import Iterator, List
 from sshtunnel import SSHTunnelForwarder
 import os
 
 from src.config import CONFIG
-from src.models.segment import SegmentCreateInDB
+from src.models.segment import SegmentCreate, SegmentCreateInDB
+from src.utils.metrics import METRICS
+
+
+_ARROW_TYPES = {
+    FIELD_TYPE.TINY: pa.int64(),
+    FIELD_TYPE.SHORT: pa.int64(),
+    FIELD_TYPE.LONG: pa.int64(),
+    FIELD_TYPE.LONGLONG: pa.int64(),
+    FIELD_TYPE.INT24: pa.int64(),
+    FIELD_TYPE.YEAR: pa.int64(),
+    FIELD_TYPE.FLOAT: pa.float64(),
+    FIELD_TYPE.DOUBLE: pa.float64(),
+    FIELD_TYPE.TIMESTAMP: pa.timestamp("us"),
+    FIELD_TYPE.DATETIME: pa.timestamp("us"),
+    FIELD_TYPE.DATE: pa.date32(),
+    FIELD_TYPE.NEWDATE: pa.date32(),
+    FIELD_TYPE.TIME: pa.duration("us"),
+    FIELD_TYPE.NULL: pa.null(),
+}
+
+
+def _arrow_type(column_description) -> pa.DataType:
+    _, type_code, _, _, precision, scale, _ = column_description
+    if type_code in (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL):
+        return pa.decimal128(min(max(precision or 0, 1), 38), scale or 0)
+    return _ARROW_TYPES.get(type_code, pa.string())
 
 
 class Database:
@@ -67,17 +95,17 @@ class Database:
         :return: Pandas DataFrame containing results for SELECT queries,
                 last inserted ID for INSERT queries, None for other queries
         """
-        if sql_query.strip().lower().startswith("select"):
-            return pd.read_sql_query(sql_query, self.sql_connection, params=params)  # type: ignore
-        else:
-            with self.sql_connection.cursor() as cursor:
-                cursor.execute(sql_query, params)
-                self.sql_connection.commit()
-                if sql_query.strip().lower().startswith("insert"):
-                    return cursor.lastrowid
+        with METRICS.span("db_query"):
+            if sql_query.strip().lower().startswith("select"):
+                return pd.read_sql_query(sql_query, self.sql_connection, params=params)  # type: ignore
+            else:
+                with self.sql_connection.cursor() as cursor:
+                    cursor.execute(sql_query, params)
+                    self.sql_connection.commit()
+                    if sql_query.strip().lower().startswith("insert"):
+                        return cursor.lastrowid
 
-    def add_audio(self, audio_name: str, corpus_id: int, duration: float) -> int:
-        query = """
+    _INSERT_AUDIO_QUERY = """
     INSERT INTO Audio
         (
             name, corpus_id, duration
@@ -87,29 +115,33 @@ class Database:
             %s, %s, %s
         )
     """
+
+    def add_audio(self, audio_name: str, corpus_id: int, duration: float) -> int:
         params = (audio_name, corpus_id, duration)
-        audio_id = self._run_query(query, params)
+        audio_id = self._run_query(self._INSERT_AUDIO_QUERY, params)
         return audio_id  # type: ignore
 
-    def add_audio_segment(self, segment: SegmentCreateInDB):
-        query = """
+    _INSERT_SEGMENT_QUERY = """
             INSERT INTO Dataset 
             (
                 file_path, file_with_user, data_gold, task, 
                 text_asr, audio_id, segment_num,
                 audio_lenght, duration, start_time, end_time, speaker_id
             )
-            VALUES 
-            (
-                %s, 0, 0, 1, 
-                %s, %s, %s,
-                %s, %s, %s, %s, %s
-            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
-        params = (
+
+    @staticmethod
+    def _segment_params(segment: SegmentCreate, audio_id: int) -> tuple:
+        # Every value is a placeholder (file_with_user, data_gold and task are
+        # constants) so pymysql can turn executemany into a multi-row INSERT.
+        return (
             segment.segment_path,
+            0,
+            0,
+            1,
             segment.text_asr,
-            segment.audio_id,
+            audio_id,
             segment.segment_num,
             segment.frames,
             segment.int_duration,
@@ -117,7 +149,42 @@ class Database:
             segment.end_time,
             segment.speaker,
         )
-        return self._run_query(query, params)
+
+    def add_audio_segment(self, segment: SegmentCreateInDB):
+        params = self._segment_params(segment, segment.audio_id)
+        return self._run_query(self._INSERT_SEGMENT_QUERY, params)
+
+    def add_audio_with_segments(
+        self,
+        audio_name: str,
+        corpus_id: int,
+        duration: float,
+        segments: List[SegmentCreate],
+    ) -> int:
+        """Inserts an audio and all of its segments in a single transaction.
+
+        The segments are sent with one multi-row INSERT, so either the whole
+        audio is persisted or nothing is.
+
+        :return audio_id: ID of the inserted audio
+        """
+        with METRICS.span("db_insert"):
+            try:
+                with self.sql_connection.cursor() as cursor:
+                    cursor.execute(
+                        self._INSERT_AUDIO_QUERY, (audio_name, corpus_id, duration)
+                    )
+                    audio_id = cursor.lastrowid
+                    if segments:
+                        cursor.executemany(
+                            self._INSERT_SEGMENT_QUERY,
+                            [self._segment_params(s, audio_id) for s in segments],
+                        )
+                self.sql_connection.commit()
+            except Exception:
+                self.sql_connection.rollback()
+                raise
+        return audio_id
 
     def update_audio_duration(self, audio_id, audio_duration):
         query = f"""
@@ -127,13 +194,16 @@ class Database:
         """
         return self._run_query(query)
 
-    def get_audios_by_name(self, audio_name):
-        query = f"""
-        SELECT *
+    def get_audio_names_by_corpus_id(self, corpus_id) -> List[str]:
+        query = """
+        SELECT name
         FROM Audio
-        WHERE name LIKE '{audio_name}%'
+        WHERE corpus_id = %s
         """
-        return self._run_query(query)
+        audios = self._run_query(query, (corpus_id,))
+        if not isinstance(audios, pd.DataFrame) or audios.empty:
+            return []
+        return audios["name"].dropna().tolist()
 
     def get_audios_by_corpus_id(self, corpus_id, filter_finished=False):
         query = f"""
@@ -159,4 +229,71 @@ class Database:
         FROM Dataset
         WHERE audio_id IN ({','.join([str(id) for id in audios_ids])})
         """
-        return self._run_query(query)
\ No newline at end of file
+        return self._run_query(query)
+
+    def iter_segments_by_audios_id_list(
+        self, audios_ids: List[int], audios_per_batch: int = 200
+    ) -> Iterator[pd.DataFrame]:
+        """Yields the segments of the given audios, a batch of audios at a time.
+
+        All the segments of an audio are always in the same batch, so memory
+        stays bounded by the batch size instead of the corpus size.
+        """
+        for start in range(0, len(audios_ids), audios_per_batch):
+            batch_ids = [int(id) for id in audios_ids[start : start + audios_per_batch]]
+            query = f"""
+            SELECT *
+            FROM Dataset
+            WHERE audio_id IN ({', '.join(['%s'] * len(batch_ids))})
+            """
+            segments = self._run_query(query, batch_ids)
+            if isinstance(segments, pd.DataFrame) and not segments.empty:
+                yield segments
+
+    def get_segment_fingerprints(
+        self, audios_ids: List[int], audios_per_batch: int = 1000
+    ) -> pd.DataFrame:
+        """Returns, per audio, the number of segments, the highest segment id
+        and a checksum of the segment rows used by the exports.
+
+        The checksum is computed by MySQL, so only one row per audio crosses
+        the connection. XOR makes it independent of the row order, and the
+        count and max id catch segments added or removed.
+        """
+        batches = []
+        for start in range(0, len(audios_ids), audios_per_batch):
+            batch_ids = [int(id) for id in audios_ids[start : start + audios_per_batch]]
+            query = f"""
+            SELECT audio_id,
+                COUNT(*) AS segments,
+                MAX(id) AS max_segment_id,
+                BIT_XOR(CAST(CONV(LEFT(MD5(CONCAT_WS('|',
+                    id, segment_num, start_time, end_time,
+                    IFNULL(speaker_id, '<null>'),
+                    IFNULL(text, '<null>'),
+                    IFNULL(text_asr, '<null>')
+                )), 16), 16, 10) AS UNSIGNED)) AS checksum
+            FROM Dataset
+            WHERE audio_id IN ({', '.join(['%s'] * len(batch_ids))})
+            GROUP BY audio_id
+            """
+            fingerprints = self._run_query(query, batch_ids)
+            if isinstance(fingerprints, pd.DataFrame) and not fingerprints.empty:
+                batches.append(fingerprints)
+        if not batches:
+            return pd.DataFrame(
+                columns=["audio_id", "segments", "max_segment_id", "checksum"]
+            )
+        return pd.concat(batches, ignore_index=True)
+
+    def get_table_arrow_schema(self, table: str) -> pa.Schema:
+        """Builds an Arrow schema from the MySQL column types of a table.
+
+        Inferring types from each DataFrame batch is unstable (e.g. a column
+        that is all NULL in one batch), so batched writers use this instead.
+        """
+        with self.sql_connection.cursor() as cursor:
+            cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+            return pa.schema(
+                [pa.field(column[0], _arrow_type(column)) for column in cursor.description]
+            )
@@ -0,0 +1,192 @@
+import io
+import mmap
+import os
+import re
+import tempfile
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional
+
+from src.config import CONFIG
+from src.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class MappedFile(io.BufferedIOBase):
+    """
+    Read-only file-like view over a memory-mapped file. It exposes the same
+    `getvalue()` as BytesIO so it can be used wherever downloaded content was
+    used before.
+    """
+
+    def __init__(self, path: Path):
+        self.name = str(path)
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        return self._mmap.read(-1 if size is None else size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+    def readinto(self, buffer) -> int:
+        data = self._mmap.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def tell(self) -> int:
+        return self._mmap.tell()
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._mmap)
+
+    def getvalue(self) -> bytes:
+        return self._mmap[:]
+
+    def close(self):
+        if not self.closed:
+            self._mmap.close()
+            self._file.close()
+        super().close()
+
+
+class DownloadCache:
+    """
+    Content-addressed on-disk cache for remote files, keyed by file id plus a
+    version tag (md5 checksum or modification time). Entries are written
+    atomically and evicted in least recently used order once the folder
+    grows past `max_size_bytes`.
+    """
+
+    def __init__(self, folder: Path, max_size_bytes: int):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "bytes_served": 0,
+            "bytes_downloaded": 0,
+            "evictions": 0,
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _safe(value: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_.-]", "-", value)
+
+    def _entry_path(self, file_id: str, version: str) -> Path:
+        return self.folder / f"{self._safe(file_id)}_{self._safe(version)}"
+
+    def get(
+        self,
+        file_id: str,
+        version: Optional[str],
+        download: Callable[[BinaryIO], None],
+        size: Optional[int] = None,
+    ) -> BinaryIO:
+        """Returns the cached content, calling `download(sink)` on a miss.
+
+        Files known to be larger than the cache are never cached.
+        """
+        if version is None or (size is not None and size > self.max_size_bytes):
+            # Without a version the entry can't be validated, and an entry
+            # bigger than the cache would evict everything, so skip the cache.
+            content = tempfile.SpooledTemporaryFile(
+                max_size=CONFIG.google_drive.spool_max_size
+            )
+            download(content)  # type: ignore
+            content.seek(0)
+            return content  # type: ignore
+
+        path = self._entry_path(file_id, version)
+        with self._lock:
+            # Under the lock so another thread's eviction can't remove the
+            # entry between the check and the open.
+            try:
+                os.utime(path)
+                content = self._open(path)
+            except FileNotFoundError:
+                self.stats["misses"] += 1
+            else:
+                self.stats["hits"] += 1
+                self.stats["bytes_served"] += path.stat().st_size
+                logger.debug(f"Cache hit for file {file_id}")
+                return content
+
+        temp_file = tempfile.NamedTemporaryFile(
+            dir=self.folder, prefix=".download_", delete=False
+        )
+        try:
+            with temp_file:
+                download(temp_file)
+            os.replace(temp_file.name, path)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+
+        size = path.stat().st_size
+        # Opened before evicting: the mapping stays valid even if the entry
+        # is removed later.
+        content = self._open(path)
+        with self._lock:
+            self.stats["bytes_downloaded"] += size
+            self._remove_stale_versions(file_id, path)
+            self._evict(path)
+        return content
+
+    @staticmethod
+    def _open(path: Path) -> BinaryIO:
+        if path.stat().st_size == 0:
+            return io.BytesIO()
+        return MappedFile(path)  # type: ignore
+
+    def _remove_stale_versions(self, file_id: str, current: Path):
+        for entry in self.folder.glob(f"{self._safe(file_id)}_*"):
+            if entry != current:
+                entry.unlink(missing_ok=True)
+
+    def _evict(self, current: Path):
+        """Removes the least recently used entries, except `current`, until
+        the folder fits in `max_size_bytes`."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_size_bytes:
+                break
+            if Path(entry.path) == current:
+                continue
+            total_size -= size
+            os.remove(entry.path)
+            self.stats["evictions"] += 1
+            logger.debug(f"Evicted {entry.name} from download cache")
+
+    def report(self) -> str:
+        return ", ".join(f"{key}={value}" for key, value in self.stats.items())
+
+
+@lru_cache(maxsize=None)
+def get_download_cache() -> Optional[DownloadCache]:
+    """Shared download cache, created on first use."""
+    if not CONFIG.download_cache.enabled:
+        return None
+    return DownloadCache(
+        CONFIG.download_cache.folder, CONFIG.download_cache.max_size_bytes
+    )
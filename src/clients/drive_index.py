@@ -0,0 +1,254 @@
+import json
+import sqlite3
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.config import CONFIG
+from src.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class DriveListingIndex:
+    """
+    Local SQLite copy of the folder trees listed from Google Drive, keyed by
+    the root folder they were crawled from. Paths are stored relative to the
+    root folder, the same way `GoogleDriveClient.get_files_from_folder` names
+    the files, so later runs can answer listings without hitting Drive.
+    Every folder belongs to one root: crawling a folder that contains an
+    indexed root takes its rows over, and subfolders of a root are listed
+    from the root's rows.
+    """
+
+    def __init__(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS folders (
+                    id TEXT PRIMARY KEY,
+                    root_id TEXT NOT NULL,
+                    parent_id TEXT,
+                    path TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    root_id TEXT NOT NULL,
+                    parent_id TEXT NOT NULL,
+                    parent_path TEXT NOT NULL,
+                    item TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_root ON files (root_id);
+                CREATE INDEX IF NOT EXISTS files_parent ON files (parent_id);
+                CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent_id);
+                """
+            )
+
+    @property
+    def changes_token(self) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'changes_token'"
+            ).fetchone()
+        return row[0] if row else None
+
+    @changes_token.setter
+    def changes_token(self, token: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('changes_token', ?)",
+                (token,),
+            )
+
+    def has_root(self, root_id: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM folders WHERE id = ? AND root_id = ?",
+                (root_id, root_id),
+            ).fetchone()
+        return row is not None
+
+    def get_folder(self, folder_id: str) -> Optional[Tuple[str, str]]:
+        """Returns (root_id, path) of an indexed folder."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT root_id, path FROM folders WHERE id = ?", (folder_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def add_tree(
+        self,
+        root_id: str,
+        folders: Iterable[Tuple[str, Optional[str], str]],
+        files: Iterable[Tuple[dict, str, str]],
+    ):
+        """Stores crawled folders as (id, parent_id, path) and files as
+        (item, parent_id, parent_path)."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO folders (id, root_id, parent_id, path) VALUES (?, ?, ?, ?)",
+                [(id, root_id, parent_id, path) for id, parent_id, path in folders],
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO files (id, root_id, parent_id, parent_path, item) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (item["id"], root_id, parent_id, parent_path, json.dumps(item))
+                    for item, parent_id, parent_path in files
+                ],
+            )
+
+    def remove(self, item_id: str):
+        """Removes a file, or a folder with everything below it."""
+        with self._lock, self._connection:
+            pending = [item_id]
+            while pending:
+                current = pending.pop()
+                pending.extend(
+                    row[0]
+                    for row in self._connection.execute(
+                        "SELECT id FROM folders WHERE parent_id = ?", (current,)
+                    )
+                )
+                self._connection.execute(
+                    "DELETE FROM files WHERE id = ? OR parent_id = ?",
+                    (current, current),
+                )
+                self._connection.execute(
+                    "DELETE FROM folders WHERE id = ?", (current,)
+                )
+
+    def get_files(self, folder_id: str) -> List[Tuple[dict, str]]:
+        """Returns the (item, parent_path) of every file under an indexed
+        folder, with paths relative to that folder.
+
+        A folder that isn't a root is answered from the rows of the root it
+        was crawled under, so each folder is owned by a single root.
+        """
+        folder = self.get_folder(folder_id)
+        if folder is None:
+            return []
+        root_id, folder_path = folder
+        with self._lock:
+            if not folder_path:
+                rows = self._connection.execute(
+                    "SELECT item, parent_path FROM files WHERE root_id = ? ORDER BY parent_path",
+                    (root_id,),
+                ).fetchall()
+            else:
+                rows = self._connection.execute(
+                    """
+                    SELECT item, parent_path FROM files
+                    WHERE root_id = ? AND (parent_path = ? OR substr(parent_path, 1, ?) = ?)
+                    ORDER BY parent_path
+                    """,
+                    (root_id, folder_path, len(folder_path) + 1, folder_path + "/"),
+                ).fetchall()
+        return [
+            (json.loads(item), path[len(folder_path) :].lstrip("/"))
+            for item, path in rows
+        ]
+
+    def close(self):
+        self._connection.close()
+
+
+class FolderIdCache:
+    """
+    Maps (parent folder id, folder name) to the id of the Drive folder, so
+    each folder of an upload path is resolved at most once. Entries live in
+    memory for the run and in SQLite between runs.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self._folders: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.RLock()
+        self._connection = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(path), check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS folders (
+                        parent_id TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        id TEXT NOT NULL,
+                        PRIMARY KEY (parent_id, name)
+                    )
+                    """
+                )
+            for parent_id, name, folder_id in self._connection.execute(
+                "SELECT parent_id, name, id FROM folders"
+            ):
+                self._folders[(parent_id, name)] = folder_id
+
+    def resolve(
+        self, parent_id: str, name: str, resolver: Callable[[], str]
+    ) -> str:
+        """Returns the cached folder id, calling `resolver` on a miss.
+
+        Misses are resolved under a lock, so concurrent uploads to a new path
+        don't create the same folder twice.
+        """
+        key = (parent_id, name)
+        folder_id = self._folders.get(key)
+        if folder_id is not None:
+            return folder_id
+
+        with self._lock:
+            folder_id = self._folders.get(key)
+            if folder_id is None:
+                folder_id = resolver()
+                self.set(parent_id, name, folder_id)
+        return folder_id
+
+    def set(self, parent_id: str, name: str, folder_id: str):
+        with self._lock:
+            self._folders[(parent_id, name)] = folder_id
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO folders (parent_id, name, id) VALUES (?, ?, ?)",
+                        (parent_id, name, folder_id),
+                    )
+
+    def invalidate(self, folder_id: str):
+        """Forgets a folder (e.g. deleted on Drive) and everything below it."""
+        with self._lock:
+            pending = [folder_id]
+            while pending:
+                current = pending.pop()
+                for key, value in list(self._folders.items()):
+                    if value == current or key[0] == current:
+                        del self._folders[key]
+                        if key[0] == current:
+                            pending.append(value)
+                if self._connection is not None:
+                    with self._connection:
+                        self._connection.execute(
+                            "DELETE FROM folders WHERE id = ? OR parent_id = ?",
+                            (current, current),
+                        )
+
+
+@lru_cache(maxsize=None)
+def get_listing_index() -> Optional[DriveListingIndex]:
+    """Shared listing index, opened on first use."""
+    if CONFIG.google_drive.listing_index_path is None:
+        return None
+    return DriveListingIndex(CONFIG.google_drive.listing_index_path)
+
+
+@lru_cache(maxsize=None)
+def get_folder_id_cache() -> FolderIdCache:
+    """Shared folder id cache, opened on first use."""
+    return FolderIdCache(CONFIG.google_drive.folder_cache_path)
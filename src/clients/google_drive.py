@@ -1,21 +1,72 @@
 import os
 import io
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 from google.oauth2 import service_account
-from typing import Literal, Optional, List
+from typing import BinaryIO, Literal, Optional, List, Tuple
 
+from src.config import CONFIG
 from src.utils.files import get_mime_from_extension
 from src.utils.logger import get_logger
+from src.utils.metrics import METRICS
 from src.clients.storage_base import BaseStorage
+from src.clients.download_cache import DownloadCache, get_download_cache
+from src.clients.upload_manager import UploadManager
+from src.clients.drive_index import (
+    DriveListingIndex,
+    FolderIdCache,
+    get_folder_id_cache,
+    get_listing_index,
+)
 from src.models.file import File, FileToUpload, AudioFormat
 
 logger = get_logger(__name__)
 
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+FILE_FIELDS = "id, name, mimeType, size, fileExtension, parents, md5Checksum, modifiedTime"
+LIST_FIELDS = f"nextPageToken, files({FILE_FIELDS})"
+CHANGES_FIELDS = f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}, trashed))"
+# Default for the caches below: the shared instances, opened on first use
+# rather than at import. None disables a cache.
+_SHARED = object()
+
 
 class GoogleDriveClient(BaseStorage):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        cache: Optional[DownloadCache] = _SHARED,  # type: ignore
+        listing_index: Optional[DriveListingIndex] = _SHARED,  # type: ignore
+        folder_cache: FolderIdCache = _SHARED,  # type: ignore
+    ) -> None:
         self.service = self.__setup_service()
+        self.cache = get_download_cache() if cache is _SHARED else cache
+        self.listing_index = (
+            get_listing_index() if listing_index is _SHARED else listing_index
+        )
+        self.folder_cache = (
+            get_folder_id_cache() if folder_cache is _SHARED else folder_cache
+        )
+        self._thread_local = threading.local()
+        self._upload_manager: Optional[UploadManager] = None
+
+    @property
+    def upload_manager(self) -> UploadManager:
+        """Background upload queue, created on first use."""
+        if self._upload_manager is None:
+            self._upload_manager = UploadManager(
+                lambda: GoogleDriveClient(
+                    cache=self.cache,
+                    listing_index=self.listing_index,
+                    folder_cache=self.folder_cache,
+                )
+            )
+        return self._upload_manager
 
     def __setup_service(self):
         return build("drive", "v3", credentials=self.__get_credentials())
@@ -53,44 +104,50 @@ class GoogleDriveClient(BaseStorage):
         filter_format: Optional[AudioFormat] = None,
         file_parents=[],
     ) -> List[File]:
-        query = f"'{folder_id}' in parents and trashed = false"
+        if self.listing_index is None:
+            with METRICS.span("drive_listing"):
+                return self._list_folder_recursively(folder_id, filter_format, file_parents)
+
+        with METRICS.span("drive_listing"):
+            # Subfolders of a crawled root are answered from the root's rows,
+            # so they are never crawled (and owned) twice.
+            if self.listing_index.get_folder(folder_id) is not None:
+                self.refresh_listing_index()
+            else:
+                self.index_folder(folder_id)
+
+        return_files = []
+        for item, parent_path in self.listing_index.get_files(folder_id):
+            file = self._to_file(
+                item, [*file_parents, *filter(None, parent_path.split("/"))], filter_format
+            )
+            if file is not None:
+                return_files.append(file)
+        return return_files
+
+    def _list_folder_recursively(
+        self,
+        folder_id,
+        filter_format: Optional[AudioFormat] = None,
+        file_parents=[],
+    ) -> List[File]:
         return_files = []
 
         page_token = None
         while True:
-            results = (
-                self.service.files()
-                .list(
-                    q=query,
-                    fields="nextPageToken, files(id, name, mimeType, size, fileExtension, parents)",
-                    pageToken=page_token,
-                )
-                .execute()
-            )
+            results = self._list_request(self.service, folder_id, page_token).execute()
             items = results.get("files", [])
 
             for item in items:
-                if item["mimeType"] == "application/vnd.google-apps.folder":
+                if item["mimeType"] == FOLDER_MIME_TYPE:
                     return_files.extend(
-                        self.get_files_from_folder(
+                        self._list_folder_recursively(
                             item["id"], filter_format, [*file_parents, item["name"]]
                         )
                     )
                 else:
-                    file_name, file_extension = os.path.splitext(item["name"])
-                    if (
-                        filter_format is None
-                        or file_extension == filter_format.value
-                        or item["fileExtension"] == filter_format.value
-                    ):
-                        file = File(
-                            id=item["id"],
-                            name="/".join([*file_parents, file_name]),
-                            size=int(item["size"]),
-                            mime_type=item["mimeType"],
-                            extension=item["fileExtension"],
-                            parents=item["parents"],
-                        )
+                    file = self._to_file(item, file_parents, filter_format)
+                    if file is not None:
                         return_files.append(file)
 
             page_token = results.get("nextPageToken")
@@ -99,21 +156,265 @@ class GoogleDriveClient(BaseStorage):
 
         return return_files
 
-    def get_file_content(self, file: File) -> io.BytesIO:
-        request = self.service.files().get_media(fileId=file.id)
-        file_content = io.BytesIO()
+    @staticmethod
+    def _to_file(
+        item: dict, file_parents: List[str], filter_format: Optional[AudioFormat]
+    ) -> Optional[File]:
+        file_name, file_extension = os.path.splitext(item["name"])
+        if (
+            filter_format is None
+            or file_extension == filter_format.value
+            or item["fileExtension"] == filter_format.value
+        ):
+            return File(
+                id=item["id"],
+                name="/".join([*file_parents, file_name]),
+                size=int(item["size"]),
+                mime_type=item["mimeType"],
+                extension=item["fileExtension"],
+                parents=item["parents"],
+                md5_checksum=item.get("md5Checksum"),
+                modified_time=item.get("modifiedTime"),
+            )
+        return None
+
+    @staticmethod
+    def _list_request(service, folder_id: str, page_token: Optional[str] = None):
+        return service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            fields=LIST_FIELDS,
+            pageSize=1000,
+            pageToken=page_token,
+        )
+
+    def _thread_service(self):
+        # httplib2 connections can't be shared between threads.
+        if not hasattr(self._thread_local, "service"):
+            self._thread_local.service = self.__setup_service()
+        return self._thread_local.service
+
+    def crawl_folder(
+        self,
+        folder_id: str,
+        base_path: str = "",
+        executor: Optional[ThreadPoolExecutor] = None,
+    ) -> Tuple[List[Tuple[str, str, str]], List[Tuple[dict, str, str]]]:
+        """Lists a folder tree breadth first.
+
+        Each level is split into chunks that are listed concurrently, and the
+        first page of every folder in a chunk is requested in a single batch
+        HTTP request. Pass `executor` to share one pool across several crawls.
 
-        downloader = MediaIoBaseDownload(file_content, request)
+        :return: (folder_id, parent_id, path) of the subfolders and
+            (item, parent_id, parent_path) of the files
+        """
+        workers = CONFIG.google_drive.listing_workers
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return self.crawl_folder(folder_id, base_path, executor)
 
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        return io.BytesIO(file_content.getvalue())
+        folders: List[Tuple[str, str, str]] = []
+        files: List[Tuple[dict, str, str]] = []
+        frontier = [(folder_id, base_path)]
+
+        while frontier:
+            chunk_size = max(
+                1,
+                min(CONFIG.google_drive.listing_batch_size, -(-len(frontier) // workers)),
+            )
+            chunks = [
+                frontier[i : i + chunk_size]
+                for i in range(0, len(frontier), chunk_size)
+            ]
+            frontier = []
+            for children in executor.map(self._list_children, chunks):
+                for item, parent_id, parent_path in children:
+                    if item["mimeType"] == FOLDER_MIME_TYPE:
+                        path = "/".join(filter(None, [parent_path, item["name"]]))
+                        folders.append((item["id"], parent_id, path))
+                        frontier.append((item["id"], path))
+                    else:
+                        files.append((item, parent_id, parent_path))
+
+        return folders, files
+
+    def _list_children(
+        self, folders: List[Tuple[str, str]]
+    ) -> List[Tuple[dict, str, str]]:
+        service = self._thread_service()
+        responses = {}
+
+        def collect(request_id, response, exception):
+            responses[request_id] = None if exception is not None else response
+
+        batch = service.new_batch_http_request(callback=collect)
+        for idx, (folder_id, _) in enumerate(folders):
+            batch.add(self._list_request(service, folder_id), request_id=str(idx))
+        batch.execute()
+
+        children = []
+        for idx, (folder_id, path) in enumerate(folders):
+            response = responses.get(str(idx))
+            if response is None:
+                # Failed inside the batch (usually rate limiting), retry alone.
+                response = self._list_request(service, folder_id).execute(
+                    num_retries=CONFIG.google_drive.download_max_retries
+                )
+            while True:
+                children.extend(
+                    (item, folder_id, path) for item in response.get("files", [])
+                )
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+                response = self._list_request(service, folder_id, page_token).execute(
+                    num_retries=CONFIG.google_drive.download_max_retries
+                )
+        return children
+
+    def index_folder(self, folder_id: str):
+        """Crawls a folder tree and stores it in the listing index."""
+        if self.listing_index is None:
+            raise Exception("Listing index is disabled.")
+
+        if self.listing_index.changes_token is None:
+            # Taken before crawling so no change made during the crawl is lost.
+            self.listing_index.changes_token = (
+                self.service.changes().getStartPageToken().execute()["startPageToken"]
+            )
+
+        indexed_folder = self.listing_index.get_folder(folder_id)
+        if indexed_folder is not None and indexed_folder[0] != folder_id:
+            raise ValueError(
+                f"Folder {folder_id} is already indexed under root {indexed_folder[0]}."
+            )
+
+        logger.info(f"Crawling folder {folder_id} into the listing index.")
+        folders, files = self.crawl_folder(folder_id)
+        self.listing_index.remove(folder_id)
+        self.listing_index.add_tree(folder_id, [(folder_id, None, ""), *folders], files)
+        logger.info(f"Indexed {len(folders)} folders and {len(files)} files.")
+
+    def refresh_listing_index(self):
+        """Applies the Drive changes made since the last refresh to the index."""
+        if self.listing_index is None or self.listing_index.changes_token is None:
+            return
+
+        page_token = self.listing_index.changes_token
+        applied = 0
+        # Threads are only started if a changed folder has to be crawled.
+        with ThreadPoolExecutor(
+            max_workers=CONFIG.google_drive.listing_workers
+        ) as executor:
+            while page_token:
+                response = (
+                    self.service.changes()
+                    .list(pageToken=page_token, pageSize=1000, fields=CHANGES_FIELDS)
+                    .execute()
+                )
+                for change in response.get("changes", []):
+                    applied += self._apply_change(change, executor)
+
+                page_token = response.get("nextPageToken")
+                if page_token:
+                    self.listing_index.changes_token = page_token
+                if "newStartPageToken" in response:
+                    self.listing_index.changes_token = response["newStartPageToken"]
+
+        if applied:
+            logger.info(f"Applied {applied} Drive changes to the listing index.")
+
+    def _apply_change(self, change: dict, executor: ThreadPoolExecutor) -> int:
+        index = self.listing_index
+        assert index is not None
+        file_id = change["fileId"]
+        item = change.get("file")
+        deleted = change.get("removed") or item is None or item.get("trashed")
+
+        indexed_folder = index.get_folder(file_id)
+        if indexed_folder is not None and indexed_folder[0] == file_id and not deleted:
+            # A crawled root changed (e.g. renamed); its listing doesn't.
+            return 0
+
+        index.remove(file_id)
+        if deleted:
+            return 1
+
+        parent_id = next(
+            (parent for parent in item.get("parents", []) if index.get_folder(parent)),
+            None,
+        )
+        if parent_id is None:
+            return 0
+
+        root_id, parent_path = index.get_folder(parent_id)  # type: ignore
+        if item["mimeType"] == FOLDER_MIME_TYPE:
+            path = "/".join(filter(None, [parent_path, item["name"]]))
+            folders, files = self.crawl_folder(file_id, path, executor)
+            index.add_tree(root_id, [(file_id, parent_id, path), *folders], files)
+        else:
+            index.add_tree(root_id, [], [(item, parent_id, parent_path)])
+        return 1
+
+    def get_file_content(self, file: File) -> BinaryIO:
+        if self.cache is None:
+            # Small files stay in memory, big ones are spooled to disk.
+            file_content = tempfile.SpooledTemporaryFile(
+                max_size=CONFIG.google_drive.spool_max_size
+            )
+            self.download_file(file, file_content)
+            file_content.seek(0)
+            return file_content  # type: ignore
+
+        return self.cache.get(
+            file.id,
+            file.version,
+            lambda sink: self.download_file(file, sink),
+            size=file.size,
+        )
+
+    def download_file(
+        self,
+        file: File,
+        sink: BinaryIO,
+        chunk_size: int = CONFIG.google_drive.download_chunk_size,
+        max_retries: int = CONFIG.google_drive.download_max_retries,
+    ):
+        """Streams the file content into `sink`, one chunk at a time.
+
+        Each chunk is requested with an HTTP Range header starting at the
+        bytes already written, so after a transient failure the download
+        resumes where it stopped instead of starting over.
+        """
+        request = self.service.files().get_media(fileId=file.id)
+        downloader = MediaIoBaseDownload(sink, request, chunksize=chunk_size)
+
+        start_position = sink.tell()
+        with METRICS.span("download"):
+            done = False
+            retries = 0
+            while done is False:
+                try:
+                    status, done = downloader.next_chunk()
+                    retries = 0
+                except (HttpError, OSError) as e:
+                    if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUS:
+                        raise
+                    retries += 1
+                    if retries > max_retries:
+                        raise
+                    wait = 2**retries
+                    logger.warning(
+                        f"Download of {file.name} interrupted ({e}). Resuming in {wait}s."
+                    )
+                    time.sleep(wait)
+        METRICS.add("download_bytes", sink.tell() - start_position)
 
     def upload_file_to_folder(
-        self, parent_folder_id, file: FileToUpload
+        self, parent_folder_id, file: FileToUpload, retry_missing_folder: bool = True
     ) -> Optional[str]:
         levels = file.name.split("/")
+        root_folder_id = parent_folder_id
         if len(levels) > 1:
             for level in levels[:-1]:
                 parent_folder_id = self.create_folder(level, parent_folder_id)
@@ -130,14 +431,42 @@ class GoogleDriveClient(BaseStorage):
         else:
             raise Exception("No file content or path provided")
 
-        uploaded_file = (
-            self.service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
-        )
+        try:
+            uploaded_file = (
+                self.service.files()
+                .create(body=file_metadata, media_body=media, fields="id")
+                .execute()
+            )
+        except HttpError as e:
+            if (
+                e.resp.status != 404
+                or parent_folder_id == root_folder_id
+                or not retry_missing_folder
+            ):
+                raise
+            # A cached folder was deleted on Drive, resolve the path again.
+            logger.warning(f"Folder {parent_folder_id} not found, resolving it again.")
+            self.folder_cache.invalidate(root_folder_id)
+            return self.upload_file_to_folder(
+                root_folder_id, file, retry_missing_folder=False
+            )
         logger.info("File ID: %s" % uploaded_file.get("id"))
         return uploaded_file.get("id", None)
 
+    def find_file_in_folder(self, parent_folder_id, name: str) -> Optional[str]:
+        """Returns the id of the file at the relative path `name`, if any."""
+        levels = name.split("/")
+        for level in levels[:-1]:
+            parent_folder_id = self.create_folder(level, parent_folder_id)
+
+        escaped_name = levels[-1].replace("'", "\\'")
+        query = f"'{parent_folder_id}' in parents and name='{escaped_name}' and trashed=false"
+        results = (
+            self.service.files().list(q=query, fields="files(id)", pageSize=1).execute()
+        )
+        items = results.get("files", [])
+        return items[0]["id"] if items else None
+
     def upload_folder_to_folder(
         self, parent_folder_id, folder_name, local_folder_path
     ) -> List[str]:
@@ -175,20 +504,27 @@ class GoogleDriveClient(BaseStorage):
                 parent_folder_id = self.create_folder(level, parent_folder_id)
             return parent_folder_id
         else:
-            existing_folder = self.get_folder_by_name(parent_folder_id, folder_name)
-            if existing_folder is not None:
-                return existing_folder["id"]
-
-            file_metadata = {
-                "name": folder_name,
-                "parents": [parent_folder_id],
-                "mimeType": "application/vnd.google-apps.folder",
-            }
-            file = (
-                self.service.files().create(body=file_metadata, fields="id").execute()
+            return self.folder_cache.resolve(
+                parent_folder_id,
+                folder_name,
+                lambda: self._get_or_create_folder(folder_name, parent_folder_id),
             )
-            logger.info("Folder ID: %s" % file.get("id"))
-            return file.get("id")
+
+    def _get_or_create_folder(self, folder_name, parent_folder_id) -> str:
+        existing_folder = self.get_folder_by_name(parent_folder_id, folder_name)
+        if existing_folder is not None:
+            return existing_folder["id"]
+
+        file_metadata = {
+            "name": folder_name,
+            "parents": [parent_folder_id],
+            "mimeType": "application/vnd.google-apps.folder",
+        }
+        file = (
+            self.service.files().create(body=file_metadata, fields="id").execute()
+        )
+        logger.info("Folder ID: %s" % file.get("id"))
+        return file.get("id")
 
     def get_folder_by_name(self, parent_id, folder_name) -> Optional[dict]:
         query = f"mimeType='application/vnd.google-apps.folder' and '{parent_id}' in parents and name='{folder_name}' and trashed=false"
@@ -228,7 +564,7 @@ class GoogleDriveClient(BaseStorage):
                 .list(
                     q=query,
                     pageSize=10,
-                    fields="nextPageToken, files(id, name, size, mimeType, fileExtension, parents)",
+                    fields="nextPageToken, files(id, name, size, mimeType, fileExtension, parents, md5Checksum, modifiedTime)",
                 )
                 .execute()
             )
@@ -250,6 +586,8 @@ class GoogleDriveClient(BaseStorage):
                         mime_type=items[0]["mimeType"],
                         extension=items[0]["fileExtension"],
                         parents=items[0]["parents"],
+                        md5_checksum=items[0].get("md5Checksum"),
+                        modified_time=items[0].get("modifiedTime"),
                     )
 
             # If the audio file is not found, search in the subfolders
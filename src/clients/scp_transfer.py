@@ -1,15 +1,19 @@
 import paramiko
 from scp import SCPClient
 import os
-import pipes
+import shlex
+import tarfile
 from enum import Enum
 from pathlib import Path
+from typing import Iterable, List, Tuple
 
 from src.config import CONFIG
 from src.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+MAX_COMMAND_LENGTH = 100_000
+
 
 class ContentType(Enum):
     FILES = "files"
@@ -44,20 +48,24 @@ class FileTransfer:
         return client
 
     def mkdir(self, folder_path: str, recursive: bool = False):
-        command = f"printf '%q ' mkdir -p {pipes.quote(folder_path)}"  # Ignore error if the folder already exists
-        stdin, stdout, stderr = self.ssh.exec_command(command)
-
-        # exec_command() returns file-like objects representing the input (stdin),
-        # output (stdout) and error (stderr) channels from the SSH session.
-        # You may need to call read() or readlines() on these objects to retrieve the actual command output.
-        out = stdout.readlines()
-        err = stderr.readlines()
-
-        injected_command = "".join(out)
-        # reinterpret printf output as a command
-
-        # command = f"mkdir -p -v {folder_path}"  # Ignore error if the folder already exists
-        self.ssh.exec_command(injected_command)
+        self.mkdirs([folder_path])
+
+    def mkdirs(self, folder_paths: Iterable[str]):
+        """Creates all the folders with as few `mkdir -p` commands as possible."""
+        commands = []
+        command = "mkdir -p --"
+        for folder_path in sorted(set(folder_paths)):
+            quoted = f" {shlex.quote(folder_path)}"
+            if len(command) + len(quoted) > MAX_COMMAND_LENGTH:
+                commands.append(command)
+                command = "mkdir -p --"
+            command += quoted
+        commands.append(command)
+
+        for command in commands:
+            stdin, stdout, stderr = self.ssh.exec_command(command)
+            if stdout.channel.recv_exit_status() != 0:
+                logger.error(f"Error creating folders: {stderr.read().decode()}")
 
     def put(self, source: str, target: str, target_is_folder: bool = False, **kwargs):
         if target_is_folder:
@@ -76,6 +84,69 @@ class FileTransfer:
         else:
             logger.debug(f"File transfered successfully.")
 
+    def put_many(self, transfers: List[Tuple[str, str]]):
+        """Transfers many (source, target) files in a couple of round trips.
+
+        All target folders are created with a single mkdir pass, then the
+        files under the remote dataset folder are sent as one tar stream
+        extracted there, instead of one SCP session per file. Files outside
+        of it, or all of them if the extraction fails, are sent one by one.
+        """
+        if not transfers:
+            return
+
+        self.mkdirs(os.path.dirname(target) for _, target in transfers)
+
+        base_path = CONFIG.remote.dataset_path
+        archived: List[Tuple[str, str]] = []
+        single: List[Tuple[str, str]] = []
+        for source, target in transfers:
+            arcname = os.path.relpath(target, base_path)
+            if arcname == os.curdir or arcname.startswith(os.pardir):
+                single.append((source, target))
+            else:
+                archived.append((source, arcname))
+
+        if archived:
+            try:
+                self._put_archive(base_path, archived)
+            except Exception as e:
+                logger.warning(
+                    f"Error extracting files on the server, sending them one by one: {e}"
+                )
+                single.extend(
+                    (source, os.path.join(base_path, arcname))
+                    for source, arcname in archived
+                )
+            else:
+                logger.debug(f"{len(archived)} files transfered successfully.")
+
+        for source, target in single:
+            self.put(source, target)
+
+    @staticmethod
+    def _normalize_tarinfo(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        # Extracted files belong to the remote user, with default permissions.
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        tarinfo.mode = 0o755 if tarinfo.isdir() else 0o644
+        return tarinfo
+
+    def _put_archive(self, base_path: str, files: List[Tuple[str, str]]):
+        """Sends (source, arcname) files as a tar stream extracted in `base_path`."""
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"tar -x --no-same-owner -f - -C {shlex.quote(base_path)}"
+        )
+        try:
+            with tarfile.open(fileobj=stdin, mode="w|") as tar:
+                for source, arcname in files:
+                    tar.add(source, arcname=arcname, filter=self._normalize_tarinfo)
+        finally:
+            stdin.channel.shutdown_write()
+
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(stderr.read().decode())
+
     def read_all_files(self, path):
         command = f"ls {path}"
         stdin, stdout, stderr = self.ssh.exec_command(command)
@@ -1,6 +1,5 @@
 from abc import ABC, abstractmethod
-from io import BytesIO
-from typing import Optional, List
+from typing import BinaryIO, Optional, List
 
 from src.models.file import File, FileToUpload
 
@@ -13,7 +12,7 @@ class BaseStorage(ABC):
         pass
 
     @abstractmethod
-    def get_file_content(self, file_name) -> BytesIO:
+    def get_file_content(self, file_name) -> BinaryIO:
         pass
 
     @abstractmethod
@@ -0,0 +1,227 @@
+import os
+import random
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src.config import CONFIG
+from src.models.file import FileToUpload
+from src.utils.logger import get_logger
+from src.utils.metrics import METRICS
+
+logger = get_logger(__name__)
+
+RETRYABLE_UPLOAD_STATUS = (403, 429, 500, 502, 503, 504)
+# Network failures that don't reach Drive, so they carry no HTTP status.
+RETRYABLE_TRANSPORT_ERRORS = (
+    socket.timeout,
+    ConnectionError,
+    ssl.SSLError,
+    httplib2.HttpLib2Error,
+)
+
+
+class UploadManager:
+    """
+    Uploads files to Google Drive in the background with a bounded pool of
+    workers. Every upload is written to an on-disk journal before it starts
+    and marked as done when it finishes, so a run that crashed can `resume()`
+    the pending uploads without uploading the finished ones again. Entries
+    keep the size and mtime of the local file, so a file rewritten after its
+    upload is uploaded again.
+
+    Only uploads from a local `path` are journaled; in-memory content can't
+    outlive the process.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        journal_path: Path = CONFIG.google_drive.upload_journal_path,
+        workers: int = CONFIG.google_drive.upload_workers,
+        max_retries: int = CONFIG.google_drive.upload_max_retries,
+        max_pending: int = CONFIG.google_drive.upload_max_pending,
+    ):
+        self.client_factory = client_factory
+        self.max_retries = max_retries
+        self._thread_local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="uploader"
+        )
+        # Backpressure: producers block when too many uploads are queued.
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: List[Future] = []
+        self._futures_lock = threading.Lock()
+
+        Path(journal_path).parent.mkdir(parents=True, exist_ok=True)
+        self._journal = sqlite3.connect(str(journal_path), check_same_thread=False)
+        self._journal_lock = threading.Lock()
+        with self._journal_lock, self._journal:
+            self._journal.execute(
+                """
+                CREATE TABLE IF NOT EXISTS uploads (
+                    parent_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    extension TEXT,
+                    mime_type TEXT,
+                    status TEXT NOT NULL,
+                    drive_id TEXT,
+                    size INTEGER,
+                    mtime REAL,
+                    PRIMARY KEY (parent_id, name)
+                )
+                """
+            )
+            # Journals from before the file version was recorded.
+            columns = {row[1] for row in self._journal.execute("PRAGMA table_info(uploads)")}
+            for column, column_type in (("size", "INTEGER"), ("mtime", "REAL")):
+                if column not in columns:
+                    self._journal.execute(
+                        f"ALTER TABLE uploads ADD COLUMN {column} {column_type}"
+                    )
+
+    def _client(self):
+        # Drive clients (httplib2) can't be shared between threads.
+        if not hasattr(self._thread_local, "client"):
+            self._thread_local.client = self.client_factory()
+        return self._thread_local.client
+
+    def submit(self, parent_folder_id: str, file: FileToUpload) -> Optional[Future]:
+        """Queues an upload. Files already uploaded by a previous run are
+        skipped, unless the local file changed (size or mtime) since then."""
+        if file.path is not None:
+            stat = os.stat(file.path)
+            with self._journal_lock, self._journal:
+                row = self._journal.execute(
+                    "SELECT status, size, mtime FROM uploads WHERE parent_id = ? AND name = ?",
+                    (parent_folder_id, file.name),
+                ).fetchone()
+                if row is not None and row == ("done", stat.st_size, stat.st_mtime):
+                    logger.debug(f"File {file.name} already uploaded. Skipping...")
+                    return None
+                self._journal.execute(
+                    "INSERT OR REPLACE INTO uploads (parent_id, name, path, extension, mime_type, status, size, mtime) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+                    (
+                        parent_folder_id,
+                        file.name,
+                        file.path,
+                        file.extension,
+                        file.mime_type,
+                        stat.st_size,
+                        stat.st_mtime,
+                    ),
+                )
+        return self._enqueue(parent_folder_id, file, check_existing=False)
+
+    def resume(self) -> int:
+        """Queues the uploads left pending by a previous run."""
+        with self._journal_lock:
+            rows = self._journal.execute(
+                "SELECT parent_id, name, path, extension, mime_type FROM uploads WHERE status = 'pending'"
+            ).fetchall()
+
+        for parent_id, name, path, extension, mime_type in rows:
+            file = FileToUpload(
+                name=name, path=path, extension=extension, mime_type=mime_type
+            )
+            # The previous run may have crashed after the upload finished but
+            # before it was journaled, so look for the file first.
+            self._enqueue(parent_id, file, check_existing=True)
+        if rows:
+            logger.info(f"Resuming {len(rows)} pending uploads.")
+        return len(rows)
+
+    def _enqueue(
+        self, parent_folder_id: str, file: FileToUpload, check_existing: bool
+    ) -> Future:
+        self._slots.acquire()
+        # Uploads are accounted to the audio being saved when they were queued.
+        future = self._executor.submit(
+            self._upload, parent_folder_id, file, check_existing, METRICS.current_audio()
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._futures_lock:
+            self._futures.append(future)
+        return future
+
+    def _upload(
+        self,
+        parent_folder_id: str,
+        file: FileToUpload,
+        check_existing: bool,
+        audio_name: Optional[str] = None,
+    ) -> Optional[str]:
+        with METRICS.audio(audio_name), METRICS.span("upload"):
+            drive_id = self._upload_with_retries(parent_folder_id, file, check_existing)
+            if file.path is not None:
+                METRICS.add("upload_bytes", os.path.getsize(file.path))
+
+        if file.path is not None:
+            with self._journal_lock, self._journal:
+                self._journal.execute(
+                    "UPDATE uploads SET status = 'done', drive_id = ? WHERE parent_id = ? AND name = ?",
+                    (drive_id, parent_folder_id, file.name),
+                )
+        return drive_id
+
+    def _upload_with_retries(
+        self, parent_folder_id: str, file: FileToUpload, check_existing: bool
+    ) -> Optional[str]:
+        client = self._client()
+        for attempt in range(self.max_retries + 1):
+            try:
+                drive_id = None
+                if check_existing:
+                    drive_id = client.find_file_in_folder(parent_folder_id, file.name)
+                if drive_id is None:
+                    drive_id = client.upload_file_to_folder(parent_folder_id, file)
+                return drive_id
+            except (HttpError, *RETRYABLE_TRANSPORT_ERRORS) as e:
+                retryable = (
+                    e.resp.status in RETRYABLE_UPLOAD_STATUS
+                    if isinstance(e, HttpError)
+                    else True
+                )
+                if not retryable or attempt == self.max_retries:
+                    logger.error(f"Error uploading {file.name}: {e}")
+                    raise
+                reason = (
+                    f"status {e.resp.status}"
+                    if isinstance(e, HttpError)
+                    else type(e).__name__
+                )
+                wait = 2**attempt + random.random()
+                logger.warning(
+                    f"Upload of {file.name} failed with {reason}. Retrying in {wait:.1f}s."
+                )
+                time.sleep(wait)
+        return None
+
+    def join(self) -> int:
+        """Waits for the queued uploads and returns how many failed."""
+        with self._futures_lock:
+            futures, self._futures = self._futures, []
+
+        failed = 0
+        for future in futures:
+            if future.exception() is not None:
+                failed += 1
+        if failed:
+            logger.error(
+                f"{failed} uploads failed. They stay in the journal and will be retried on the next run."
+            )
+        return failed
+
+    def close(self):
+        self.join()
+        self._executor.shutdown()
+        self._journal.close()
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
+from pathlib import Path
 from typing import Optional
 
 
@@ -31,8 +32,54 @@ class RemoteMachine(BaseModel):
 
 class Computation(BaseModel):
     batch_size: int = 8
-    compute_type: str = "float16"
+    # None picks the fastest type supported by the device (float16 on CUDA,
+    # int8 on CPU).
+    compute_type: Optional[str] = None
     whisper_model: str = "large-v2"
+    # None uses CUDA when available.
+    device: Optional[str] = None
+    # 0 splits the available cores between the workers.
+    cpu_threads: int = 0
+    num_workers: int = 1
+    warmup: bool = True
+    max_cached_models: int = 4
+    # Pack the VAD chunks of several audios into the same ASR batches.
+    cross_file_batching: bool = False
+    cross_file_max_audios: int = 4
+
+
+class Pipeline(BaseModel):
+    loader_workers: int = 2
+    persistence_workers: int = 1
+    max_prefetched_audios: int = 2
+    max_pending_saves: int = 2
+    segment_writer_workers: int = 4
+    # Folder for the memory-mapped decoded audios. None uses the system's
+    # temporary folder.
+    audio_buffer_folder: Optional[Path] = None
+    # File where each run appends its per-audio stage timings, as Parquet if
+    # it ends in .parquet and as JSON lines otherwise.
+    metrics_path: Optional[Path] = Path("./logs/metrics.jsonl")
+
+
+class GoogleDrive(BaseModel):
+    download_chunk_size: int = 32 * 1024**2
+    download_max_retries: int = 5
+    spool_max_size: int = 64 * 1024**2
+    listing_workers: int = 8
+    listing_batch_size: int = 50
+    listing_index_path: Optional[Path] = Path("./data/.cache/drive_listing.sqlite")
+    folder_cache_path: Optional[Path] = Path("./data/.cache/drive_folders.sqlite")
+    upload_workers: int = 4
+    upload_max_retries: int = 6
+    upload_max_pending: int = 1000
+    upload_journal_path: Path = Path("./data/.cache/drive_uploads.sqlite")
+
+
+class DownloadCache(BaseModel):
+    enabled: bool = True
+    folder: Path = Path("./data/.cache/downloads")
+    max_size_bytes: int = 50 * 1024**3
 
 
 class Config(BaseSettings):
@@ -43,6 +90,9 @@ class Config(BaseSettings):
     sample_rate: int = 16000
     mono_channel: bool = True
     computation: Computation = Computation()
+    pipeline: Pipeline = Pipeline()
+    google_drive: GoogleDrive = GoogleDrive()
+    download_cache: DownloadCache = DownloadCache()
 
     class Config:
         env_file = ".env", "../.env", "../../.env"
@@ -1,18 +1,29 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional
 import numpy as np
 
 
 class Audio(BaseModel):
     """
     Class to represent an audio file
+
+    The samples are usually a view over a memory-mapped buffer (see
+    `AudioLoaderService.decode`), so they are never copied by the model, and
+    they are left out of `repr()` and serialization: logging an Audio only
+    prints its metadata.
     """
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     name: str
-    bytes: np.ndarray
+    bytes: np.ndarray = Field(repr=False, exclude=True)
     sample_rate: int
     # channels: int
-    non_silent_interval: np.ndarray
+    non_silent_interval: np.ndarray = Field(repr=False, exclude=True)
     parent_folder_id: str
+    # Linear peak and RMS of the whole signal, computed while trimming.
+    peak: Optional[float] = None
+    rms: Optional[float] = None
 
     @property
     def name_with_no_spaces(self) -> str:
@@ -42,6 +53,23 @@ class Audio(BaseModel):
     def end_offset_trimmed_audio(self) -> float:
         return self.duration - self.non_silent_interval[1] / self.sample_rate
 
-    class Config:
-        arbitrary_types_allowed = True
-        json_encoders = {np.ndarray: lambda x: x.tolist()}
+    def normalize(self, target_peak: float = 0.98) -> None:
+        """Scales the samples in place when they clip (peak above 1.0)."""
+        peak = self.peak
+        if peak is None:
+            # max/min instead of np.abs(...).max() to avoid a temporary copy.
+            peak = max(float(self.bytes.max()), -float(self.bytes.min()))
+        if peak > 1.0:
+            gain = target_peak / peak
+            self.bytes *= gain
+            self.peak = target_peak
+            if self.rms is not None:
+                self.rms *= gain
+
+    def __str__(self) -> str:
+        return (
+            f"Audio(name={self.name!r}, duration={self.duration:.2f}s, "
+            f"sample_rate={self.sample_rate}, "
+            f"silence=({self.start_offset_trimmed_audio:.2f}s, {self.end_offset_trimmed_audio:.2f}s), "
+            f"peak={self.peak}, rms={self.rms})"
+        )
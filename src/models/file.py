@@ -9,6 +9,16 @@ class AudioFormat(str, Enum):
     WAV = "wav"
     MP4 = "mp4"
     MP3 = "mp3"
+    FLAC = "flac"
+    OPUS = "opus"
+
+
+class SegmentFormat(str, Enum):
+    """Formats the segment audio files can be written in."""
+
+    WAV = "wav"
+    FLAC = "flac"
+    OPUS = "opus"
 
 
 class File(BaseModel):
@@ -18,6 +28,12 @@ class File(BaseModel):
     extension: AudioFormat
     parents: List[str]
     size: int
+    md5_checksum: Optional[str] = None
+    modified_time: Optional[str] = None
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.md5_checksum or self.modified_time
 
     @property
     def _extension(self) -> str:
@@ -5,14 +5,19 @@ from tqdm import tqdm
 import locale
 from pandas import DataFrame
 import pandas as pd
-from typing import List, Optional
-import os
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, closing
+from functools import partial
+import hashlib
 
-from src.services.exporter import Exporter
+from src.services.exporter import Exporter, EXPORT_AUDIO_FORMATS
 
 from src.clients.database import Database
-from src.models.file import AudioFormat, File
+from src.models.file import AudioFormat, File, SegmentFormat
 from src.clients.google_drive import GoogleDriveClient
+from src.utils.export_manifest import ExportManifest
+from src.utils.metrics import METRICS
 
 
 from src.utils import logger as lg
@@ -23,8 +28,47 @@ locale.getpreferredencoding = lambda: "UTF-8"
 logger = lg.get_logger(__name__)
 logger.setLevel(level=DEBUG)
 
-def check_file_exists(audio_folder_path, file_name):
-    return os.path.exists(os.path.join(audio_folder_path, file_name))
+MANIFEST_NAME = ".export_manifest.sqlite"
+
+# Names of the artifacts recorded in the export manifest.
+JSON_METADATA = "json_metadata"
+CONCATENATED_TEXT = "concatenated_text"
+SPEAKERS_TEXT = "speakers_text"
+TEXTGRID = "textgrid"
+SEGMENTS = "segments"
+WEBDATASET = "webdataset"
+
+# Audio id of the artifacts that cover the whole corpus.
+CORPUS_ARTIFACTS = 0
+
+
+def original_audio_artifact(audio_format: AudioFormat) -> str:
+    return f"audio_{audio_format.value}"
+
+
+def segment_clips_artifact(audio_format: SegmentFormat) -> str:
+    return f"segment_clips_{audio_format.value}"
+
+
+def artifact_path(
+    output_folder: Path, corpus_id: int, audio_id: int, audio_name: str, artifact: str
+) -> Path:
+    """Where an artifact of an audio is written, to check it's still there."""
+    if artifact == WEBDATASET:
+        return output_folder / "webdataset" / f"corpus_{corpus_id}_index.jsonl"
+    if artifact == SEGMENTS:
+        return output_folder / "segments" / f"corpus_id={corpus_id}" / f"audio_id={audio_id}"
+    if artifact.startswith("segment_clips_"):
+        return output_folder / audio_name / "segments"
+    if artifact.startswith("audio_"):
+        return output_folder / audio_name / f"{audio_name}.{artifact[len('audio_'):]}"
+    return output_folder / audio_name / {
+        JSON_METADATA: f"{audio_name}_metadata.json",
+        CONCATENATED_TEXT: f"{audio_name}_concatenated_text.txt",
+        SPEAKERS_TEXT: f"{audio_name}_by_speaker.txt",
+        TEXTGRID: f"{audio_name}.textgrid",
+    }[artifact]
+
 
 def export_corpus_dataset(
     corpus_id: int,
@@ -41,7 +85,35 @@ def export_corpus_dataset(
     export_speakers_text: bool = False,
     export_json_metadata: bool = False,
     export_text_grid: bool = False,
+    copy_original_format: bool = False,
+    export_webdataset: bool = False,
+    segments_folder: Optional[Path] = None,
+    export_segment_clips: bool = False,
+    segment_clip_format: SegmentFormat = SegmentFormat.WAV,
+    shard_size_mb: int = 1024,
+    workers: int = 1,
+    audios_per_batch: int = 200,
+    full_export: bool = False,
 ):
+    """Exports the requested artifacts of the corpus to `output_folder`.
+
+    The artifacts already written are recorded in an `ExportManifest` in the
+    output folder, with the fingerprint of the data they came from. Only the
+    segments of audios with stale artifacts, or artifacts missing on disk, are
+    read from the database, unless `full_export` discards the manifest.
+    """
+    if export_original_audios:
+        unsupported_formats = [
+            audio_format.value
+            for audio_format in export_audio_to_formats
+            if audio_format not in EXPORT_AUDIO_FORMATS
+        ]
+        if unsupported_formats:
+            raise ValueError(
+                f"Original audios can't be exported as {unsupported_formats}, use any of {[f.value for f in EXPORT_AUDIO_FORMATS]}."
+            )
+
+    METRICS.reset()
     audios = db.get_audios_by_corpus_id(corpus_id, filter_finished=True)
 
     if not isinstance(audios, DataFrame) or audios.empty:
@@ -51,36 +123,90 @@ def export_corpus_dataset(
     if debug:
         audios = audios.sample(10)
 
-    segments = db.get_segments_by_audios_id_list(audios.id.tolist())
+    if export_webdataset:
+        assert (
+            segments_folder is not None
+        ), "You must provide the folder with the transcribed segments for exporting a WebDataset."
 
-    if not isinstance(segments, DataFrame) or segments.empty:
-        logger.info(f"No segments found for corpus {corpus_id}.")
-        return
+    with closing(ExportManifest(output_folder / MANIFEST_NAME)) as manifest:
+        if full_export:
+            manifest.clear(corpus_id)
+        exported_artifacts = manifest.get_artifacts(corpus_id)
 
-    exporter = Exporter(output_folder)
-    files_dict_by_name = {}
-    if export_original_audios:
-        assert (
-            google_drive_folder_ids is not None
-        ), "You must provide at least one folder ID from Google Drive for exporting original audios."
-        assert (
-            filter_format is not None
-        ), "You must provide a format for searching the audio files in Google Drive (wav, mp3 or mp4)."
+        fingerprints = _fingerprint_audios(db, audios)
+        if not fingerprints:
+            logger.info(f"No segments found for corpus {corpus_id}.")
+            return
 
-        storage_client = GoogleDriveClient()
-        files: List[File] = storage_client.get_files_from_folders(
-            folder_ids=google_drive_folder_ids, filter_format=filter_format
+        text_artifacts = [
+            artifact
+            for artifact, enabled in [
+                (JSON_METADATA, export_json_metadata),
+                (CONCATENATED_TEXT, export_concanated_text),
+                (SPEAKERS_TEXT, export_speakers_text),
+                (TEXTGRID, export_text_grid),
+            ]
+            if enabled
+        ]
+        clips_artifact = segment_clips_artifact(segment_clip_format)
+        segment_artifacts = (
+            ([SEGMENTS] if export_to_csv else [])
+            + ([clips_artifact] if export_segment_clips else [])
+            + text_artifacts
         )
+        audio_names = audios.set_index("id")["name"]
+
+        def is_stale(audio_id: int, artifact: str, fingerprint: str) -> bool:
+            # Artifacts deleted from disk are exported again.
+            return exported_artifacts.get(
+                (audio_id, artifact)
+            ) != fingerprint or not artifact_path(
+                output_folder,
+                corpus_id,
+                audio_id,
+                audio_names.get(audio_id, ""),
+                artifact,
+            ).exists()
 
-        files_dict_by_name: dict[str, File] = {
-            File.clean_name(file.name): file for file in files
+        stale_artifacts = {
+            audio_id: [
+                artifact
+                for artifact in segment_artifacts
+                if is_stale(audio_id, artifact, fingerprint)
+            ]
+            for audio_id, fingerprint in fingerprints.items()
         }
+        stale_artifacts = {
+            audio_id: stale for audio_id, stale in stale_artifacts.items() if stale
+        }
+
+        # Only the audios with stale artifacts are read from the database.
+        audio_ids_to_read = [id for id in fingerprints if id in stale_artifacts]
+        logger.info(
+            f"{len(audio_ids_to_read)} of {len(fingerprints)} audios have artifacts to export."
+        )
+
+        files_dict_by_name = {}
+        storage_client = None
+        if export_original_audios or export_segment_clips:
+            assert (
+                google_drive_folder_ids is not None
+            ), "You must provide at least one folder ID from Google Drive for exporting original audios or segment clips."
+            assert (
+                filter_format is not None
+            ), "You must provide a format for searching the audio files in Google Drive (wav, mp3 or mp4)."
 
-    if export_to_csv:
-        logger.info(f"Exporting audios and segments for corpus {corpus_id} to csv.")
-        exporter.export_to_csv(corpus_id, audios, segments)
+            storage_client = GoogleDriveClient()
+            files: List[File] = storage_client.get_files_from_folders(
+                folder_ids=google_drive_folder_ids, filter_format=filter_format
+            )
+
+            files_dict_by_name: dict[str, File] = {
+                File.clean_name(file.name): file for file in files
+            }
+
+        exporter = Exporter(output_folder, storage_client, encoding_workers=max(workers, 2))
 
-    if export_concanated_text or export_speakers_text or export_text_grid or export_json_metadata or export_original_audios:
         prepared_audios = audios.rename(
             columns={
                 "id": "audio_id",
@@ -88,56 +214,250 @@ def export_corpus_dataset(
                 "duration": "audio_duration",
             }
         )
-        # Joining the DataFrames
-        merged_df = pd.merge(segments, prepared_audios, on="audio_id")
 
-        # Group by audio_id
-        grouped = merged_df.groupby("audio_id")
+        audio_rows = {}
+        if export_json_metadata:
+            for _, audio in audios.iterrows():
+                audio_rows.setdefault(audio["name"], audio)
 
-        for audio_id, group in tqdm(grouped):
-            # Get the audio_name for this audio_id
-            audio_name = group["audio_name"].iloc[0]
-            logger.info(
-                f" # Working on the export of audio {audio_name}."
-            )
-
-            # Sort the group by segment_num
-            sorted_group = group.sort_values("segment_num")
+        export_texts = partial(_export_audio_texts, output_folder)
 
-            if export_json_metadata and not check_file_exists(output_folder / audio_name, f"{audio_name}_metadata.json"):
-                
-                logger.info(f"Exporting metadata to json.")
-                audio = audios[audios.name == audio_name].iloc[0]
-                exporter.export_audio_metadata(audio)
-                
-            if export_concanated_text and not check_file_exists(output_folder / audio_name, f"{audio_name}_concatenated_text.txt"):
-                logger.info(
-                    f"Exporting concatenated text file."
+        # Segments are read a batch of audios at a time, and every consumer works
+        # on the current batch, so memory doesn't grow with the corpus size.
+        with ExitStack() as stack:
+            segments_writer = None
+            if export_to_csv:
+                logger.info(f"Exporting audios to csv and segments to parquet for corpus {corpus_id}.")
+                exporter.export_audios_to_csv(corpus_id, audios)
+                segments_writer = exporter.segments_dataset_writer(
+                    corpus_id, db.get_table_arrow_schema("Dataset")
                 )
-                exporter.export_concatenated_text_file(audio_name, sorted_group)
 
-            if export_speakers_text and not check_file_exists(output_folder / audio_name, f"{audio_name}_by_speaker.txt"):
-                logger.info(f"Exporting speakers text file.")
-                exporter.export_speakers_text_file(audio_name, sorted_group)
+            executor = None
+            if text_artifacts and workers > 1:
+                logger.info(f"Exporting text files with {workers} workers.")
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+
+            progress = stack.enter_context(tqdm(total=len(audio_ids_to_read)))
+            for segments in db.iter_segments_by_audios_id_list(
+                audio_ids_to_read, audios_per_batch
+            ):
+                if segments_writer is not None:
+                    stale_segments = segments[
+                        segments["audio_id"].map(
+                            lambda audio_id: SEGMENTS in stale_artifacts[audio_id]
+                        )
+                    ]
+                    if not stale_segments.empty:
+                        segments_writer.write(stale_segments)
+                        for audio_id in stale_segments["audio_id"].unique():
+                            manifest.add_artifacts(
+                                corpus_id, audio_id, [SEGMENTS], fingerprints[audio_id]
+                            )
 
-            if export_text_grid and not check_file_exists(output_folder / audio_name, f"{audio_name}.textgrid"):
-                logger.info(f"Exporting text grid file.")
-                exporter.export_textgrid_file(audio_name, sorted_group)
+                # Joining the DataFrames
+                merged_df = pd.merge(segments, prepared_audios, on="audio_id")
 
-            if export_original_audios and (not check_file_exists(output_folder / audio_name, f"{audio_name}.wav") or not check_file_exists(output_folder / audio_name, f"{audio_name}.mp3")):
-                assert (
-                    google_drive_folder_ids is not None
-                ), "You must provide at least one folder ID from Google Drive for exporting original audios."
-                assert (
-                    filter_format is not None
-                ), "You must provide a format for searching the audio files in Google Drive (wav, mp3 or mp4)."
+                if export_segment_clips:
+                    for audio_id, group in merged_df.groupby("audio_id"):
+                        if clips_artifact not in stale_artifacts[audio_id]:
+                            continue
+                        audio_name = group["audio_name"].iloc[0]
+                        try:
+                            exported = exporter.export_segment_clips(
+                                audio_name,
+                                group,
+                                files_dict_by_name,
+                                sample_rate,
+                                segment_clip_format,
+                            )
+                        except Exception as e:
+                            # Left out of the manifest, so the next run retries it.
+                            logger.error(f"Couldn't export the segment clips of audio {audio_name}: {e}")
+                            continue
+                        if exported:
+                            manifest.add_artifacts(
+                                corpus_id, audio_id, [clips_artifact], fingerprints[audio_id]
+                            )
 
+                # Group by audio_id
+                groups = []
+                for audio_id, group in merged_df.groupby("audio_id"):
+                    artifacts = [a for a in stale_artifacts[audio_id] if a in text_artifacts]
+                    if artifacts:
+                        groups.append(
+                            (group, audio_rows.get(group["audio_name"].iloc[0]), artifacts)
+                        )
+                    else:
+                        progress.update()
+                if not groups:
+                    continue
+
+                if executor is not None:
+                    # Audios are sharded across the workers in chunks; results
+                    # come back in order, one tick per audio on a single bar.
+                    chunksize = max(1, len(groups) // (workers * 4))
+                    results = executor.map(export_texts, *zip(*groups), chunksize=chunksize)
+                else:
+                    results = (export_texts(*group) for group in groups)
+                for audio_id, artifacts in results:
+                    manifest.add_artifacts(
+                        corpus_id, audio_id, artifacts, fingerprints[audio_id]
+                    )
+                    progress.update()
+
+        # A debug run only sees a sample of the audios.
+        if segments_writer is not None and not debug:
+            removed_audio_ids = segments_writer.remove_other_audios(fingerprints)
+            if removed_audio_ids:
                 logger.info(
-                    f"Exporting original audio."
+                    f"Removed the segments of {len(removed_audio_ids)} audios no longer in corpus {corpus_id}."
+                )
+                manifest.remove_audios(corpus_id, removed_audio_ids)
+
+        if export_webdataset:
+            # The shards are a snapshot of the whole corpus, repacked only
+            # when the segments of some audio changed.
+            corpus_fingerprint = _hash(
+                "\n".join(
+                    [
+                        f"{segments_folder}:{shard_size_mb}",
+                        *(f"{id}:{fingerprints[id]}" for id in sorted(fingerprints)),
+                    ]
+                )
+            )
+            if is_stale(CORPUS_ARTIFACTS, WEBDATASET, corpus_fingerprint):
+                logger.info(f"Exporting segments of corpus {corpus_id} to WebDataset shards.")
+                index_path = exporter.export_webdataset(
+                    corpus_id,
+                    segments_folder,  # type: ignore
+                    {audio_id: audio_names[audio_id] for audio_id in fingerprints},
+                    shard_size=shard_size_mb * 1024**2,
+                    workers=workers,
+                )
+                manifest.add_artifacts(
+                    corpus_id, CORPUS_ARTIFACTS, [WEBDATASET], corpus_fingerprint
+                )
+                logger.info(f"WebDataset index written to {index_path}.")
+            else:
+                logger.info(f"WebDataset shards of corpus {corpus_id} are up to date.")
+
+        if export_original_audios:
+            # Original audios don't depend on the segments; they are exported
+            # again only when the file on Drive changes.
+            pending_originals = []
+            for audio_id in fingerprints:
+                audio_file = files_dict_by_name.get(File.clean_name(audio_names[audio_id]))
+                original_fingerprint = (
+                    f"{audio_file.id}:{audio_file.version}" if audio_file is not None else ""
+                )
+                stale_formats = [
+                    audio_format
+                    for audio_format in export_audio_to_formats
+                    if is_stale(
+                        audio_id, original_audio_artifact(audio_format), original_fingerprint
+                    )
+                ]
+                if stale_formats:
+                    pending_originals.append((audio_id, stale_formats, original_fingerprint))
+
+            for audio_id, stale_formats, original_fingerprint in tqdm(pending_originals):
+                # Formats exported from a previous version of the file are
+                # replaced; the others are kept if they are already on disk.
+                replaced = any(
+                    (audio_id, original_audio_artifact(audio_format)) in exported_artifacts
+                    for audio_format in stale_formats
                 )
-                exporter.export_original_audios(
-                    audio_name,
+                exported_formats = exporter.export_original_audios(
+                    audio_names[audio_id],
                     files_dict_by_name,
                     sample_rate,
-                    export_audio_to_formats,
+                    stale_formats,
+                    copy_matching_format=copy_original_format,
+                    overwrite=replaced,
+                )
+                manifest.add_artifacts(
+                    corpus_id,
+                    audio_id,
+                    [original_audio_artifact(f) for f in exported_formats],
+                    original_fingerprint,
                 )
+
+    logger.info(f"Time per stage:\n{METRICS.summary()}")
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+
+def _fingerprint_audios(db: Database, audios: DataFrame) -> Dict[int, str]:
+    """Fingerprints each audio with segments from its segment checksum and the
+    Audio columns used by the exports."""
+    segment_fingerprints = db.get_segment_fingerprints(audios.id.tolist())
+    merged = pd.merge(
+        segment_fingerprints, audios, left_on="audio_id", right_on="id"
+    )
+    return {
+        int(audio_id): _hash(
+            f"{segments}|{max_segment_id}|{checksum}|{name}|{duration}|{metadata}"
+        )
+        for audio_id, segments, max_segment_id, checksum, name, duration, metadata in zip(
+            merged["audio_id"],
+            merged["segments"],
+            merged["max_segment_id"],
+            merged["checksum"],
+            merged["name"],
+            merged["duration"],
+            merged["json_metadata"],
+        )
+    }
+
+
+def _export_audio_texts(
+    output_folder: Path,
+    group: DataFrame,
+    audio: Optional[pd.Series],
+    artifacts: List[str],
+) -> Tuple[int, List[str]]:
+    """Writes the given text artifacts of an audio and returns its id with the
+    artifacts written."""
+    # Module level so it can be pickled into the export worker processes.
+    exporter = Exporter(output_folder)
+
+    audio_id = int(group["audio_id"].iloc[0])
+    if not artifacts:
+        return audio_id, []
+
+    # Get the audio_name for this audio_id
+    audio_name = group["audio_name"].iloc[0]
+    logger.info(
+        f" # Working on the export of audio {audio_name}."
+    )
+
+    # Sort the group by segment_num
+    sorted_group = group.sort_values("segment_num")
+
+    written = []
+    if JSON_METADATA in artifacts and audio is not None:
+        logger.info(f"Exporting metadata to json.")
+        exporter.export_audio_metadata(audio)
+        written.append(JSON_METADATA)
+
+    if CONCATENATED_TEXT in artifacts:
+        logger.info(
+            f"Exporting concatenated text file."
+        )
+        exporter.export_concatenated_text_file(audio_name, sorted_group)
+        written.append(CONCATENATED_TEXT)
+
+    if SPEAKERS_TEXT in artifacts:
+        logger.info(f"Exporting speakers text file.")
+        exporter.export_speakers_text_file(audio_name, sorted_group)
+        written.append(SPEAKERS_TEXT)
+
+    if TEXTGRID in artifacts:
+        logger.info(f"Exporting text grid file.")
+        exporter.export_textgrid_file(audio_name, sorted_group)
+        written.append(TEXTGRID)
+
+    return audio_id, written
@@ -3,7 +3,11 @@ from logging import DEBUG
 from pathlib import Path
 from tqdm import tqdm
 import locale
-from typing import Literal, Callable, Optional, List
+from typing import Literal, Callable, Optional, List, Deque, Tuple
+from collections import deque
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
 from pandas import DataFrame
 
 from src.services.audio_loader_service import AudioLoaderService
@@ -16,10 +20,12 @@ from src.clients.scp_transfer import FileTransfer
 
 from src.models.audio import Audio
 from src.models.segment import Segment
-from src.models.file import File, AudioFormat
+from src.models.file import File, AudioFormat, SegmentFormat
 
 from src.utils import logger as lg
 from src.utils.exceptions import EmptyAudio
+from src.utils.prefix_index import PrefixIndex
+from src.utils.metrics import METRICS
 
 from src.config import CONFIG
 
@@ -30,6 +36,31 @@ logger = lg.get_logger(__name__)
 logger.setLevel(level=DEBUG)
 
 
+_thread_local = threading.local()
+
+
+def _load_audio_in_worker(file: File) -> Audio:
+    # The Drive client (httplib2) is not thread safe, so each loader thread
+    # keeps its own client.
+    if not hasattr(_thread_local, "audio_loader_service"):
+        _thread_local.audio_loader_service = AudioLoaderService(GoogleDriveClient())
+
+    logger.info(f"Loading audio {file.name}.")
+    audio: Audio = _thread_local.audio_loader_service.load_audio(
+        file, CONFIG.sample_rate, CONFIG.mono_channel
+    )
+    logger.info(f"Audio loaded: {audio}")
+    return audio
+
+
+def _wait_for_save(file: File, future: Future):
+    try:
+        future.result()
+        logger.info(f"Transcription of {file.name} saved")
+    except Exception as e:
+        logger.error(f"Something went wrong when saving audio {file.name}: {e}")
+
+
 def transcribe_audios_in_folder(
     corpus_id: int,
     folder_ids: List[str],
@@ -39,11 +70,27 @@ def transcribe_audios_in_folder(
     save_to_drive: bool = False,
     storage_output_folder_id: Optional[str] = None,
     format_filter: Optional[AudioFormat] = None,
+    segment_format: SegmentFormat = SegmentFormat.WAV,
     get_db_search_key: Callable[..., str] = lambda x: x,
 ):
+    """
+    Transcribes the audios as a three stage pipeline: a pool of loaders
+    downloads and decodes the next audios while the current one is being
+    transcribed, and a pool of persistence workers saves the finished ones.
+    Both queues are bounded by CONFIG.pipeline, so at most
+    `max_prefetched_audios + max_pending_saves + 1` decoded audios are kept
+    in memory.
+
+    With `CONFIG.computation.cross_file_batching`, up to
+    `cross_file_max_audios` loaded audios are transcribed together so their
+    chunks fill the ASR batches (see `TranscriptionService.recognize_batch`).
+    """
+    run_id = datetime.now().isoformat(timespec="seconds")
+    METRICS.reset()
     storage_client = GoogleDriveClient()
     transcription_service = TranscriptionService()
-    audio_loader_service = AudioLoaderService(storage_client)
+    if CONFIG.computation.warmup:
+        transcription_service.warmup()
     output_service = OutputPersistanceService(
                 output_folder,
                 db=db,
@@ -52,54 +99,142 @@ def transcribe_audios_in_folder(
             )
 
     
+    if save_to_drive:
+        storage_client.upload_manager.resume()
+
     files: List[File] = storage_client.get_files_from_folders(
         folder_ids=folder_ids, filter_format=format_filter
     )
     logger.info(
         f"On the folders with ids {folder_ids}, we have {len(files)} audios{f' with format {format_filter.value}' if format_filter else ''}."
     )
-    for audio in tqdm(files):
+
+    processed_audios = (
+        PrefixIndex(db.get_audio_names_by_corpus_id(corpus_id))
+        if db is not None
+        else None
+    )
+    if processed_audios is not None:
+        logger.info(f"Corpus {corpus_id} has {len(processed_audios)} processed audios.")
+
+    files_to_process: List[File] = []
+    for audio in files:
         # Handle NURC special conditions
         audio.name = (
             audio.name.replace("_sem_cabecalho", "")
             .replace("_sem_cabecallho", "")
             .replace("_sem_cabeçalho", "")
         )
-        if db is not None:
-            audios_with_name = db.get_audios_by_name(get_db_search_key(audio.name))
-            if isinstance(audios_with_name, DataFrame) and not audios_with_name.empty:
-                logger.info(f"Audio {audio.name} already processed. Skipping...")
+        search_key = get_db_search_key(audio.name)
+        if processed_audios is not None and processed_audios.has_prefix(search_key):
+            logger.info(f"Audio {audio.name} already processed. Skipping...")
+            continue
+        if processed_audios is not None:
+            # Later files mapping to the same search key (e.g. NURC names
+            # that only differ by the suffixes above) are duplicates.
+            processed_audios.add(search_key)
+        files_to_process.append(audio)
+
+    pipeline_config = CONFIG.pipeline
+    # Audios transcribed together; more than one packs their chunks into the
+    # same ASR batches.
+    group_size = (
+        CONFIG.computation.cross_file_max_audios
+        if CONFIG.computation.cross_file_batching
+        else 1
+    )
+    max_prefetched_audios = max(pipeline_config.max_prefetched_audios, group_size)
+    pending_loads: Deque[Tuple[File, Future]] = deque()
+    pending_saves: Deque[Tuple[File, Future]] = deque()
+    files_iterator = iter(files_to_process)
+
+    with ThreadPoolExecutor(
+        max_workers=pipeline_config.loader_workers, thread_name_prefix="loader"
+    ) as loaders, ThreadPoolExecutor(
+        max_workers=pipeline_config.persistence_workers, thread_name_prefix="saver"
+    ) as savers, tqdm(total=len(files_to_process)) as progress:
+
+        def prefetch():
+            while len(pending_loads) < max_prefetched_audios:
+                file = next(files_iterator, None)
+                if file is None:
+                    return
+                pending_loads.append((file, loaders.submit(_load_audio_in_worker, file)))
+
+        def next_group() -> List[Tuple[File, Audio]]:
+            group: List[Tuple[File, Audio]] = []
+            while pending_loads and len(group) < group_size:
+                audio, load_future = pending_loads.popleft()
+                prefetch()
+                try:
+                    group.append((audio, load_future.result()))
+                except EmptyAudio as e:
+                    logger.error(f"Audio {audio.name} with error and couldn't be loaded.")
+                    progress.update(1)
+                except Exception as e:
+                    logger.error(f"Something went wrong when loading audio {audio.name}")
+                    progress.update(1)
+            return group
+
+        prefetch()
+        while pending_loads:
+            group = next_group()
+            if not group:
                 continue
 
-        try:
-            logger.info(f"Loading audio {audio.name}.")
-            audio_to_process: Audio = audio_loader_service.load_audio(
-                audio, CONFIG.sample_rate, CONFIG.mono_channel
-            )
-            logger.info(audio_to_process)
-            logger.info(f"Audio loaded.")
-
-            logger.info(f"Starting transcription")
-            segments: List[Segment] = transcription_service.transcribe(audio_to_process)
-            logger.info("Audio processed")
-            
-            logger.info("Saving transcription")
-            output_service.save_transcription(
-                corpus_id=corpus_id,
-                audio=audio_to_process,
-                segments=segments,
-                audio_export_format=AudioFormat.WAV,
-                remote_storage_folder_id=storage_output_folder_id or audio.parents[0],
-            )
-            logger.info("Transcription saved")
+            logger.info(f"Starting transcription of {len(group)} audios")
+            try:
+                transcriptions = transcription_service.recognize_batch(
+                    [audio_to_process for _, audio_to_process in group]
+                )
+            except Exception as e:
+                logger.error(
+                    f"Something went wrong when transcribing audios {[audio.name for audio, _ in group]}: {e}"
+                )
+                progress.update(len(group))
+                continue
 
-        except EmptyAudio as e:
-            logger.error(f"Audio {audio.name} with error and couldn't be loaded.")
-            continue
-        
-        except Exception as e:
-            logger.error(f"Something went wrong when processing audio {audio.name}")
-            continue
-        
+            for (audio, audio_to_process), transcription in zip(group, transcriptions):
+                progress.update(1)
+                try:
+                    segments: List[Segment] = transcription_service.assign_segments(
+                        audio_to_process, transcription
+                    )
+                    logger.info("Audio processed")
+
+                    # Backpressure: don't let finished audios pile up in memory
+                    # when persistence is slower than transcription.
+                    while len(pending_saves) >= pipeline_config.max_pending_saves:
+                        _wait_for_save(*pending_saves.popleft())
+
+                    logger.info("Saving transcription")
+                    save_future = savers.submit(
+                        output_service.save_transcription,
+                        corpus_id=corpus_id,
+                        audio=audio_to_process,
+                        segments=segments,
+                        audio_export_format=segment_format,
+                        remote_storage_folder_id=storage_output_folder_id or audio.parents[0],
+                    )
+                    pending_saves.append((audio, save_future))
+
+                except Exception as e:
+                    logger.error(f"Something went wrong when processing audio {audio.name}")
+                    continue
 
-    pass
+        while pending_saves:
+            _wait_for_save(*pending_saves.popleft())
+
+    if save_to_drive:
+        logger.info("Waiting for the uploads to Google Drive to finish")
+        storage_client.upload_manager.close()
+        
+    if CONFIG.pipeline.metrics_path is not None:
+        METRICS.write(CONFIG.pipeline.metrics_path, run_id)
+        logger.info(f"Per-audio metrics written to {CONFIG.pipeline.metrics_path}")
+    logger.info(
+        f"Time per stage:\n{METRICS.summary()}\n{transcription_service.report()}"
+    )
+    logger.info(f"Model cache usage:\n{transcription_service.models.report()}")
+    if storage_client.cache is not None:
+        logger.info(f"Download cache usage: {storage_client.cache.report()}")
@@ -1,18 +1,24 @@
-import librosa
-import io
 import numpy as np
-from typing import Optional, Union, Tuple, Literal
-from googleapiclient.http import MediaIoBaseDownload
+from typing import BinaryIO, Optional, Tuple
 import tempfile
 import subprocess
+import shutil
+import threading
+import mmap
 import os
 
+from src.config import CONFIG
 from src.utils.exceptions import EmptyAudio
+from src.utils.metrics import METRICS
+from src.utils.silence import trim_silence
 from src.clients.storage_base import BaseStorage
 from src.models.audio import Audio
 from src.models.file import File, AudioFormat
 
 
+PCM_READ_SIZE = 1024**2
+
+
 class AudioLoaderService:
     def __init__(self, repository_client: BaseStorage) -> None:
         self.remote = repository_client
@@ -25,76 +31,200 @@ class AudioLoaderService:
         mono_channel: bool,
         normalize: bool = True,
     ) -> Audio:
-        if file.extension == AudioFormat.WAV or file.extension == AudioFormat.MP3:
-            audio_ndarray, loaded_sampling_rate = librosa.load(
-                self.remote.get_file_content(file),
-                sr=sample_rate,
-                mono=mono_channel,
-            )
-        elif file.extension == AudioFormat.MP4:
-            audio_ndarray, loaded_sampling_rate = self.__get_audio_from_mp4(
-                file, sample_rate, mono_channel
-            )
-        else:
+        with METRICS.audio(file.name):
+            return self._load_audio(file, sample_rate, mono_channel, normalize)
+
+    def _load_audio(
+        self,
+        file: File,
+        sample_rate: int,
+        mono_channel: bool,
+        normalize: bool,
+    ) -> Audio:
+        if file.extension not in list(AudioFormat):
             raise ValueError("Invalid audio format.")
 
+        audio_ndarray, loaded_sampling_rate = self.decode(
+            file, sample_rate, mono_channel
+        )
+
         assert (
             loaded_sampling_rate == sample_rate
         ), "Couldn't read audio with desired sampling rate."
 
-        _, non_silent_indexes = librosa.effects.trim(audio_ndarray, top_db=20)
-        if normalize:
-            peak = np.abs(audio_ndarray).max()
-            if peak > 1.0:
-                audio_ndarray = 0.98 * audio_ndarray / peak
+        with METRICS.span("trim"):
+            trim = trim_silence(audio_ndarray, top_db=20)
 
-        return Audio(
+        audio = Audio(
             name=file.name,
             parent_folder_id=file.parents[0],
             bytes=audio_ndarray,
             sample_rate=int(loaded_sampling_rate),
-            non_silent_interval=non_silent_indexes,
+            non_silent_interval=trim.non_silent_interval,
+            peak=trim.peak,
+            rms=trim.rms,
         )
+        METRICS.set("audio_duration", audio.duration)
+        if normalize:
+            with METRICS.span("normalize"):
+                audio.normalize()
+        return audio
 
-    def __get_audio_from_mp4(
+    def decode(
         self,
         file: File,
         sample_rate: int,
         mono_channel: bool,
-    ) -> Tuple[np.ndarray, float]:
+    ) -> Tuple[np.ndarray, int]:
+        """Decodes the file with ffmpeg, resampled to `sample_rate`.
+
+        ffmpeg writes raw float32 PCM to its stdout, which is spooled to an
+        unlinked temporary file and memory-mapped, so there is no intermediate
+        WAV file, no second resampling pass and the samples live in the page
+        cache instead of the Python heap. The mapping is writable, so the
+        samples can be normalized in place. Like librosa, mono audio is
+        returned as a 1-D array and multichannel audio as (channels, samples),
+        keeping the channels of the first audio stream.
+        """
         file_content = self.remote.get_file_content(file)
+        local_path = getattr(file_content, "name", None)
+        on_disk = isinstance(local_path, str) and os.path.isfile(local_path)
+
+        with METRICS.span("decode"):
+            # MP4 containers may keep their index at the end of the file, and
+            # multichannel audio is probed before decoding, so ffmpeg needs a
+            # seekable file instead of a pipe.
+            if not on_disk and (
+                file.extension == AudioFormat.MP4 or not mono_channel
+            ):
+                with tempfile.NamedTemporaryFile(suffix=file._extension) as temp_file:
+                    shutil.copyfileobj(file_content, temp_file)
+                    file_content.close()
+                    temp_file.flush()
+                    pcm, channels = self.__decode_file(
+                        temp_file.name, sample_rate, mono_channel
+                    )
+            elif on_disk:
+                pcm, channels = self.__decode_file(local_path, sample_rate, mono_channel)  # type: ignore
+                file_content.close()
+            else:
+                channels = 1
+                pcm = self.__run_ffmpeg("pipe:0", file_content, sample_rate, channels)
+                file_content.close()
+
+        if pcm is None:
+            raise EmptyAudio(f"ffmpeg decoded no samples from {file.name}")
+        audio = np.frombuffer(pcm, dtype=np.float32)
+        if channels > 1:
+            audio = audio.reshape(-1, channels).T
 
-        # Write the MP4 content to a temporary file and process with ffmpeg
-        with tempfile.NamedTemporaryFile(suffix=".mp4") as temp_file:
-            temp_file.write(file_content.getvalue())
-            temp_file.flush()
-
-            # Process the MP4 file with ffmpeg and write the audio to a WAV file
-            audio_filename = f"{temp_file.name}_audio.wav"
-            result = subprocess.run(
-                [
-                    "ffmpeg",
-                    "-i",
-                    temp_file.name,
-                    "-vn",
-                    "-acodec",
-                    "pcm_s16le",
-                    "-ar",
-                    f"{sample_rate}",
-                    "-ac",
-                    f"{1 if mono_channel else 2}",
-                    audio_filename,
-                ]
+        return audio, sample_rate
+
+    def __decode_file(
+        self, path: str, sample_rate: int, mono_channel: bool
+    ) -> Tuple[Optional[mmap.mmap], int]:
+        if mono_channel:
+            return self.__run_ffmpeg(path, None, sample_rate, 1), 1
+        channels = self.__probe_channels(path)
+        return self.__run_ffmpeg(path, None, sample_rate, None), channels
+
+    @staticmethod
+    def __probe_channels(path: str) -> int:
+        """Channel count of the first audio stream, the one ffmpeg decodes
+        when no channel count is forced."""
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "a:0",
+                "-show_entries",
+                "stream=channels",
+                "-of",
+                "csv=p=0",
+                path,
+            ],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+        channels = result.stdout.decode(errors="ignore").strip()
+        if result.returncode != 0 or not channels.isdigit():
+            raise EmptyAudio(
+                f"Error probing audio with ffprobe: {result.stderr.decode(errors='ignore')}"
             )
-            if result.returncode != 0:
-                raise EmptyAudio("Error converting MP4 file to WAV using ffmpeg")
+        return int(channels)
 
-        # Load the audio file with librosa
-        audio, sampling_rate = librosa.load(
-            audio_filename, sr=sample_rate, mono=mono_channel
+    def __run_ffmpeg(
+        self,
+        input_path: str,
+        input_stream: Optional[BinaryIO],
+        sample_rate: int,
+        channels: Optional[int],
+    ) -> Optional[mmap.mmap]:
+        """Decodes to float32 PCM, downmixed to `channels` unless it is None,
+        in which case the first audio stream keeps its own channels."""
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+        if input_stream is None:
+            command.append("-nostdin")
+        command += ["-i", input_path]
+        if channels is None:
+            command += ["-map", "0:a:0"]
+        command += [
+            "-vn",
+            "-f",
+            "f32le",
+            "-acodec",
+            "pcm_f32le",
+            "-ar",
+            f"{sample_rate}",
+        ]
+        if channels is not None:
+            command += ["-ac", f"{channels}"]
+        command.append("pipe:1")
+        # stderr goes to a file: a corrupt input can log more than a pipe
+        # holds, which would block ffmpeg while we wait on stdout.
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if input_stream is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
         )
 
-        # Remove the generated audio file (WAV) if necessary
-        os.remove(audio_filename)
+        # Feed stdin from another thread so a full stdout pipe can't deadlock.
+        writer = None
+        if input_stream is not None:
+            writer = threading.Thread(
+                target=self.__feed_stdin, args=(input_stream, process.stdin)
+            )
+            writer.start()
+
+        with stderr_file, tempfile.TemporaryFile(
+            dir=CONFIG.pipeline.audio_buffer_folder
+        ) as pcm_file:
+            shutil.copyfileobj(process.stdout, pcm_file, PCM_READ_SIZE)  # type: ignore
+
+            process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            if writer is not None:
+                writer.join()
+            if process.returncode != 0:
+                raise EmptyAudio(f"Error decoding audio with ffmpeg: {stderr.decode(errors='ignore')}")
+
+            pcm_file.flush()
+            if pcm_file.tell() == 0:
+                return None
+            # The mapping keeps its own reference to the file, which is
+            # removed when the last array viewing it is released.
+            return mmap.mmap(pcm_file.fileno(), 0)
 
-        return audio, sampling_rate
+    @staticmethod
+    def __feed_stdin(input_stream: BinaryIO, stdin: BinaryIO):
+        try:
+            shutil.copyfileobj(input_stream, stdin)
+        except BrokenPipeError:
+            pass
+        finally:
+            stdin.close()
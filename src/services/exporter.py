@@ -1,36 +1,82 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import textgrid
-from typing import List
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import soundfile as sf
+import shutil
+import tarfile
 import json
+import io
+import os
 
-from src.models.file import AudioFormat, File
+from src.models.file import AudioFormat, File, SegmentFormat
+from src.clients.storage_base import BaseStorage
 from src.clients.google_drive import GoogleDriveClient
 from src.services.audio_loader_service import AudioLoaderService
 from src.utils.logger import get_logger
+from src.utils.metrics import METRICS
 
 logger = get_logger(__name__)
 
+# soundfile (format, subtype) used for each exported audio format.
+EXPORT_AUDIO_FORMATS = {
+    AudioFormat.WAV: ("WAV", None),
+    AudioFormat.MP3: ("MP3", None),
+    AudioFormat.FLAC: ("FLAC", None),
+    AudioFormat.OPUS: ("OGG", "OPUS"),
+}
+
+# Segment audio formats packed into the WebDataset shards.
+SEGMENT_AUDIO_FORMATS = [segment_format.value for segment_format in SegmentFormat]
+
+
+class WebDatasetSample(NamedTuple):
+    key: str
+    audio_path: Path
+    text_path: Path
+    metadata: dict
+
+    @property
+    def size(self) -> int:
+        # The tar headers and the metadata are small next to the audio.
+        return os.path.getsize(self.audio_path) + os.path.getsize(self.text_path) + 2048
+
 
 class Exporter:
-    def __init__(self, output_folder: Path):
+    def __init__(
+        self,
+        output_folder: Path,
+        storage_client: Optional[BaseStorage] = None,
+        encoding_workers: int = 2,
+    ):
         output_folder.mkdir(parents=True, exist_ok=True)
         self.output_folder = output_folder
-
-    def export_to_csv(
-        self, corpus_id: int, audios: pd.DataFrame, segments: pd.DataFrame
-    ):
+        self._storage_client = storage_client
+        self.encoding_workers = encoding_workers
+
+    @property
+    def storage_client(self) -> BaseStorage:
+        # Created on first use, so exporters that only write text files (like
+        # the ones in the export worker processes) never authenticate.
+        if self._storage_client is None:
+            self._storage_client = GoogleDriveClient()
+        return self._storage_client
+
+    def export_audios_to_csv(self, corpus_id: int, audios: pd.DataFrame):
         audios.to_csv(
             self.output_folder / f"corpus_{corpus_id}_audios.csv", index=False
         )
-        segments.to_csv(
-            self.output_folder / f"corpus_{corpus_id}_segments.csv", index=False
-        )
-        segments.to_parquet(
-            self.output_folder / f"corpus_{corpus_id}_segments.parquet", index=False
+
+    def segments_dataset_writer(
+        self, corpus_id: int, schema: Optional[pa.Schema] = None
+    ) -> "SegmentsDatasetWriter":
+        return SegmentsDatasetWriter(
+            self.output_folder / "segments", corpus_id, schema
         )
-        pass
 
     def export_concatenated_text_file(self, audio_name: str, group):
         # sorted_group = group.sort_values('segment_num')
@@ -51,38 +97,7 @@ class Exporter:
         # Sort the group by segment_num, if it's not already sorted
         group = group.sort_values("segment_num")
 
-        # Initialize variables
-        current_speaker = None
-        formatted_text = ""
-        current_speaker_text = []
-
-        for _, row in group.iterrows():
-            speaker_id = row["speaker_id"]
-            text = row["text"]
-
-            # If speaker_id is null, use the current speaker, or default to 0 if it's the first segment
-            speaker_id = (
-                speaker_id
-                if pd.notnull(speaker_id)
-                else (current_speaker if current_speaker else 0)
-            )
-
-            # If the speaker has changed or it's the first segment, append the current speaker's text to formatted_text
-            if current_speaker is not None and current_speaker != speaker_id:
-                formatted_text += f'SPEAKER {int(current_speaker)}: {" ".join(current_speaker_text)}\n\n'
-                current_speaker_text = (
-                    []
-                )  # Reset current_speaker_text for the new speaker
-
-            current_speaker = speaker_id  # Update the current speaker
-            current_speaker_text.append(
-                text
-            )  # Append the text to the current speaker's text
-
-        # Append the last speaker's text
-        formatted_text += (
-            f'SPEAKER {int(current_speaker or 0)}: {" ".join(current_speaker_text)}\n'
-        )
+        formatted_text = self.format_speakers_text(group)
 
         output_file_path = self.output_folder / audio_name
         output_file_path.mkdir(parents=True, exist_ok=True)
@@ -91,6 +106,30 @@ class Exporter:
         with open(output_file_path / f"{audio_name}_by_speaker.txt", "w") as file:
             file.write(formatted_text)
 
+    @staticmethod
+    def format_speakers_text(group: pd.DataFrame) -> str:
+        """Joins consecutive segments of the same speaker into one turn.
+
+        Segments without a speaker belong to the previous speaker (or speaker
+        0 at the start). Turn boundaries are found by comparing each speaker
+        with the previous one, and each turn's text is joined in one go.
+        """
+        if group.empty:
+            return "SPEAKER 0: \n"
+
+        speakers = group["speaker_id"].ffill().fillna(0).to_numpy()
+        turn_starts = np.flatnonzero(np.r_[True, speakers[1:] != speakers[:-1]])
+        turn_ends = np.r_[turn_starts[1:], len(speakers)]
+        texts = group["text"].tolist()
+
+        return (
+            "\n\n".join(
+                f"SPEAKER {int(speakers[start])}: {' '.join(texts[start:end])}"
+                for start, end in zip(turn_starts.tolist(), turn_ends.tolist())
+            )
+            + "\n"
+        )
+
     def export_textgrid_file(self, audio_name: str, group):
         # Create a new TextGrid object
         tg = textgrid.TextGrid(
@@ -110,12 +149,13 @@ class Exporter:
                 maxTime=speaker_group["end_time"].max(),
             )
 
-            for _, row in speaker_group.iterrows():
-                interval = textgrid.Interval(
-                    row["start_time"], row["end_time"], row["text"]
-                )
+            for start_time, end_time, text in zip(
+                speaker_group["start_time"],
+                speaker_group["end_time"],
+                speaker_group["text"],
+            ):
                 # Add an interval for each segment
-                tier.addInterval(interval)
+                tier.addInterval(textgrid.Interval(start_time, end_time, text))
 
             # Add the tier to the TextGrid
             tg.append(tier)
@@ -150,9 +190,29 @@ class Exporter:
         all_files: dict[str, File],
         sample_rate: int,
         target_formats: List[AudioFormat],
-    ):
-        storage_client = GoogleDriveClient()
-
+        copy_matching_format: bool = False,
+        overwrite: bool = False,
+    ) -> List[AudioFormat]:
+        """Exports the original audio to each target format not yet on disk
+        (or to every target format with `overwrite`) and returns the target
+        formats that are now exported.
+
+        The audio is decoded once and the formats are encoded concurrently
+        from the same buffer. With `copy_matching_format`, a target format
+        equal to the source format is written by copying the original bytes,
+        keeping the source sample rate, and the audio is only decoded if
+        other formats are missing.
+        """
+        output_file_path = self.output_folder / audio_name
+        missing_formats = [
+            target_format
+            for target_format in dict.fromkeys(target_formats)
+            if overwrite
+            or not (output_file_path / f"{audio_name}.{target_format.value}").exists()
+        ]
+        if not missing_formats:
+            logger.debug(f"Audio {audio_name} already exported. Skipping.")
+            return target_formats
 
         # Get the audio file from Google Drive
         audio_file = all_files.get(File.clean_name(audio_name), None)
@@ -161,24 +221,366 @@ class Exporter:
             logger.warning(
                 f"Audio {audio_name} not found in GoogleDrive provided folders. Skipping."
             )
-            return
+            return [f for f in target_formats if f not in missing_formats]
 
         logger.debug(
             f"Audio {audio_name} found in GoogleDrive provided folders. Processing."
         )
-        # Load the audio file
-        audio = AudioLoaderService(storage_client).load_audio(
-            audio_file, sample_rate, mono_channel=True, normalize=False
-        )
-
-        output_file_path = self.output_folder / audio_name
         output_file_path.mkdir(parents=True, exist_ok=True)
 
-        logger.debug(f"Audio {audio_name} loaded. Converting to target formats.")
-        # Convert the audio file to the target formats
-        for target_format in target_formats:
-            sf.write(
-                output_file_path / f"{audio_name}.{target_format.value}",
-                audio.bytes,
-                sample_rate,
+        with METRICS.audio(audio_name):
+            if copy_matching_format and audio_file.extension in missing_formats:
+                self._copy_original_audio(
+                    audio_file, output_file_path / f"{audio_name}{audio_file._extension}"
+                )
+                missing_formats.remove(audio_file.extension)
+            if not missing_formats:
+                return target_formats
+
+            # Load the audio file
+            audio = AudioLoaderService(self.storage_client).load_audio(
+                audio_file, sample_rate, mono_channel=True, normalize=False
             )
+
+            logger.debug(f"Audio {audio_name} loaded. Converting to target formats.")
+            # Convert the audio file to the target formats. libsndfile releases
+            # the GIL while encoding, so the formats are encoded in parallel.
+            with METRICS.span("encode"), ThreadPoolExecutor(
+                max_workers=min(self.encoding_workers, len(missing_formats))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._write_audio,
+                        output_file_path / f"{audio_name}.{target_format.value}",
+                        audio.bytes,
+                        sample_rate,
+                        target_format,
+                    )
+                    for target_format in missing_formats
+                ]
+                for future in futures:
+                    future.result()
+        return target_formats
+
+    def export_segment_clips(
+        self,
+        audio_name: str,
+        segments: pd.DataFrame,
+        all_files: dict[str, File],
+        sample_rate: int,
+        audio_format: SegmentFormat,
+    ) -> bool:
+        """Cuts the segments of an audio out of its original file.
+
+        The original is decoded (and normalized, like for transcription) once,
+        and every clip is a numpy view between the `start_time` and
+        `end_time` of its row, so no samples are copied before encoding. The
+        clips are written in parallel to `{audio_name}/segments`, named like
+        the segments of the transcribe command, replacing the clips of a
+        previous export. Returns False if the original file wasn't found.
+        """
+        audio_file = all_files.get(File.clean_name(audio_name), None)
+        if audio_file is None:
+            logger.warning(
+                f"Audio {audio_name} not found in GoogleDrive provided folders. Skipping."
+            )
+            return False
+
+        with METRICS.audio(audio_name):
+            audio = AudioLoaderService(self.storage_client).load_audio(
+                audio_file, sample_rate, mono_channel=True, normalize=True
+            )
+
+            clips_folder = self.output_folder / audio_name / "segments"
+            clips_folder.mkdir(parents=True, exist_ok=True)
+            for old_clip in clips_folder.glob(f"*.{audio_format.value}"):
+                old_clip.unlink()
+
+            samples = audio.bytes
+            base_name = os.path.basename(audio_name)
+            clips = [
+                (
+                    clips_folder
+                    / f"{int(segment_num):04}_{base_name}_{start_time:.2f}_{end_time:.2f}.{audio_format.value}",
+                    samples[int(start_time * sample_rate) : int(end_time * sample_rate)],
+                )
+                for segment_num, start_time, end_time in zip(
+                    segments["segment_num"],
+                    segments["start_time"].astype(float),
+                    segments["end_time"].astype(float),
+                )
+            ]
+            logger.debug(f"Writing {len(clips)} segment clips of audio {audio_name}.")
+            with METRICS.span("encode"), ThreadPoolExecutor(
+                max_workers=self.encoding_workers
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._write_audio,
+                        path,
+                        clip,
+                        sample_rate,
+                        AudioFormat(audio_format.value),
+                    )
+                    for path, clip in clips
+                ]
+                for future in futures:
+                    future.result()
+        return True
+
+    def _copy_original_audio(self, audio_file: File, path: Path):
+        temp_path = path.with_name(f".{path.name}.part")
+        with METRICS.span("copy"):
+            file_content = self.storage_client.get_file_content(audio_file)
+            try:
+                with open(temp_path, "wb") as f:
+                    shutil.copyfileobj(file_content, f)
+            finally:
+                file_content.close()
+            os.replace(temp_path, path)
+
+    @staticmethod
+    def _write_audio(
+        path: Path, samples: np.ndarray, sample_rate: int, target_format: AudioFormat
+    ):
+        # Written under a temporary name, so an interrupted export doesn't
+        # leave a truncated file that would be skipped on the next run.
+        sf_format, sf_subtype = EXPORT_AUDIO_FORMATS[target_format]
+        temp_path = path.with_name(f".{path.name}.part")
+        sf.write(
+            temp_path, samples, sample_rate, format=sf_format, subtype=sf_subtype
+        )
+        os.replace(temp_path, path)
+
+    def export_webdataset(
+        self,
+        corpus_id: int,
+        segments_folder: Path,
+        audio_names: Dict[int, str],
+        shard_size: int = 1024**3,
+        workers: int = 1,
+    ) -> Path:
+        """Packs the segments of the audios into WebDataset tar shards.
+
+        `audio_names` maps audio ids to names. Each segment of
+        `segments_folder/{audio_name}` (the layout written by
+        `OutputPersistanceService`) becomes the `{key}.{wav,flac,opus}`,
+        `{key}.txt` and `{key}.json` members of a sample, stored next to each
+        other and in segment order, so the shards are read sequentially. The
+        samples are split into shards of about `shard_size` bytes, written in
+        parallel by `workers` processes, and `corpus_{corpus_id}_index.jsonl`
+        records the shard and byte range of every sample.
+        """
+        shards_folder = self.output_folder / "webdataset"
+        shards_folder.mkdir(parents=True, exist_ok=True)
+
+        shards: List[List[WebDatasetSample]] = [[]]
+        current_size = 0
+        for audio_id, audio_name in audio_names.items():
+            for sample in self._list_webdataset_samples(
+                corpus_id, segments_folder / audio_name, audio_id, audio_name
+            ):
+                if shards[-1] and current_size + sample.size > shard_size:
+                    shards.append([])
+                    current_size = 0
+                shards[-1].append(sample)
+                current_size += sample.size
+        if not shards[-1]:
+            shards.pop()
+
+        shard_paths = [
+            shards_folder / f"corpus_{corpus_id}-{number:06d}.tar"
+            for number in range(len(shards))
+        ]
+        logger.info(
+            f"Writing {sum(len(shard) for shard in shards)} segments to {len(shards)} shards."
+        )
+        if workers > 1 and len(shards) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                index_rows = list(executor.map(_write_webdataset_shard, shard_paths, shards))
+        else:
+            index_rows = [
+                _write_webdataset_shard(path, shard)
+                for path, shard in zip(shard_paths, shards)
+            ]
+
+        # Shards left from a previous, bigger export are removed.
+        for stale_shard in shards_folder.glob(f"corpus_{corpus_id}-*.tar"):
+            if stale_shard not in shard_paths:
+                stale_shard.unlink()
+
+        index_path = shards_folder / f"corpus_{corpus_id}_index.jsonl"
+        with open(index_path, "w", encoding="utf-8") as f:
+            for rows in index_rows:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        return index_path
+
+    @staticmethod
+    def _list_webdataset_samples(
+        corpus_id: int, audio_folder: Path, audio_id: int, audio_name: str
+    ) -> List[WebDatasetSample]:
+        audios_folder = audio_folder / "audios"
+        texts_folder = audio_folder / "texts"
+        if not audios_folder.is_dir():
+            logger.warning(f"No segments found for audio {audio_name}. Skipping.")
+            return []
+
+        summary_path = audio_folder / "summary.csv"
+        summary = {}
+        if summary_path.exists():
+            summary = {
+                row["segment_name"]: row
+                for row in pd.read_csv(summary_path, sep="|", encoding="utf-8")
+                .drop(columns=["segment_path"], errors="ignore")
+                .to_dict("records")
+            }
+
+        samples = []
+        for audio_path in sorted(audios_folder.iterdir()):
+            segment_name, extension = audio_path.name.rsplit(".", 1)
+            text_path = texts_folder / f"{segment_name}.txt"
+            if extension not in SEGMENT_AUDIO_FORMATS or not text_path.exists():
+                continue
+            metadata = {
+                **{
+                    key: None if pd.isna(value) else value
+                    for key, value in summary.get(segment_name, {}).items()
+                },
+                "corpus_id": corpus_id,
+                "audio_id": audio_id,
+                "audio_name": audio_name,
+                "segment_name": segment_name,
+            }
+            # WebDataset splits the sample key from the extension at the
+            # first dot, and segment names have dots in their times. The
+            # audio id keeps keys unique once the dots are replaced.
+            key = f"{audio_id}_{segment_name.replace('.', '_')}"
+            samples.append(WebDatasetSample(key, audio_path, text_path, metadata))
+        return samples
+
+
+def _write_webdataset_shard(path: Path, samples: List[WebDatasetSample]) -> List[dict]:
+    # Module level so it can be pickled into the export worker processes.
+    temp_path = path.with_name(f".{path.name}.part")
+    index_rows = []
+    with tarfile.open(temp_path, "w", format=tarfile.GNU_FORMAT) as tar:
+        for sample in samples:
+            start = tar.offset
+            metadata = json.dumps(sample.metadata, ensure_ascii=False).encode("utf-8")
+            members = [
+                (f"{sample.key}.{sample.audio_path.suffix[1:]}", sample.audio_path, None),
+                (f"{sample.key}.txt", sample.text_path, None),
+                (f"{sample.key}.json", None, metadata),
+            ]
+            for name, member_path, content in members:
+                info = tarfile.TarInfo(name)
+                info.mode = 0o644
+                if member_path is not None:
+                    info.size = os.path.getsize(member_path)
+                    with open(member_path, "rb") as f:
+                        tar.addfile(info, f)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+            index_rows.append(
+                {
+                    "key": sample.key,
+                    "shard": path.name,
+                    "offset": start,
+                    "size": tar.offset - start,
+                }
+            )
+    os.replace(temp_path, path)
+    return index_rows
+
+
+class SegmentsDatasetWriter:
+    """
+    Writes batches of segments to a Parquet dataset partitioned by corpus and
+    audio (`segments/corpus_id=1/audio_id=42/part-0.parquet`), so a single
+    audio's segments can be read without loading the whole corpus, e.g. with
+    `pyarrow.dataset.dataset(path, partitioning="hive")` and a filter.
+
+    Each batch must hold all the segments of its audios (as yielded by
+    `Database.iter_segments_by_audios_id_list`): the partitions of the audios
+    in a batch are replaced, and the others are left as they are until
+    `remove_other_audios` drops the ones no longer exported. The speaker and
+    text columns are written as Arrow dictionaries, since speakers and
+    repeated transcriptions (like "###") compress well that way, and readers
+    get them back as categoricals.
+    """
+
+    DICTIONARY_COLUMNS = ["speaker_id", "text", "text_asr"]
+
+    def __init__(
+        self,
+        base_dir: Path,
+        corpus_id: int,
+        schema: Optional[pa.Schema] = None,
+        rows_per_group: int = 64 * 1024,
+        compression: str = "zstd",
+    ):
+        self.base_dir = base_dir
+        self.corpus_id = corpus_id
+        self.schema = schema
+        if schema is not None and "corpus_id" not in schema.names:
+            self.schema = schema.append(pa.field("corpus_id", pa.int64()))
+        self.rows_per_group = rows_per_group
+        self.compression = compression
+
+    @property
+    def corpus_dir(self) -> Path:
+        return self.base_dir / f"corpus_id={self.corpus_id}"
+
+    def write(self, segments: pd.DataFrame):
+        segments = segments.assign(corpus_id=self.corpus_id)
+        table = pa.Table.from_pandas(
+            segments, schema=self.schema, preserve_index=False
+        )
+        if self.schema is None:
+            self.schema = table.schema
+        for column in self.DICTIONARY_COLUMNS:
+            if column in table.column_names:
+                index = table.column_names.index(column)
+                table = table.set_column(
+                    index, column, table.column(index).dictionary_encode()
+                )
+
+        file_format = ds.ParquetFileFormat()
+        ds.write_dataset(
+            table,
+            self.base_dir,
+            format=file_format,
+            file_options=file_format.make_write_options(
+                compression=self.compression
+            ),
+            partitioning=ds.partitioning(
+                pa.schema(
+                    [
+                        table.schema.field("corpus_id"),
+                        table.schema.field("audio_id"),
+                    ]
+                ),
+                flavor="hive",
+            ),
+            basename_template="part-{i}.parquet",
+            existing_data_behavior="delete_matching",
+            min_rows_per_group=min(self.rows_per_group, len(table)),
+            max_rows_per_group=self.rows_per_group,
+        )
+
+    def remove_other_audios(self, audio_ids: Iterable[int]) -> List[int]:
+        """Deletes the partitions of the corpus whose audio isn't in
+        `audio_ids` (e.g. deleted or no longer finished), so readers of the
+        dataset don't see them, and returns their ids."""
+        keep = {int(audio_id) for audio_id in audio_ids}
+        removed = []
+        if not self.corpus_dir.is_dir():
+            return removed
+        for partition in self.corpus_dir.glob("audio_id=*"):
+            audio_id = int(partition.name.split("=", 1)[1])
+            if audio_id not in keep:
+                shutil.rmtree(partition)
+                removed.append(audio_id)
+        return removed
@@ -1,8 +1,12 @@
 import os
+import threading
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from pydub import AudioSegment
-from typing import Literal, Optional
+from typing import List, Literal, Optional
 import soundfile as sf
 
 from src.clients.database import Database
@@ -11,14 +15,22 @@ from src.clients.storage_base import BaseStorage
 from src.clients.google_drive import GoogleDriveClient
 
 from src.utils.logger import get_logger
+from src.utils.metrics import METRICS
 from src.config import CONFIG
-from src.models.file import FileToUpload, AudioFormat
+from src.models.file import FileToUpload, SegmentFormat
 from src.models.audio import Audio
 from src.models.segment import Segment, SegmentCreate, SegmentCreateInDB
 
 logger = get_logger(__name__)
 logger.setLevel("DEBUG")
 
+# soundfile (format, subtype) used for each segment export format.
+SEGMENT_FORMATS = {
+    SegmentFormat.WAV.value: ("WAV", None),
+    SegmentFormat.FLAC.value: ("FLAC", None),
+    SegmentFormat.OPUS.value: ("OGG", "OPUS"),
+}
+
 class OutputPersistanceService:
     def __init__(
         self,
@@ -33,26 +45,51 @@ class OutputPersistanceService:
         self.db = db
         self.file_transfer_client = file_transfer_client
         self.remote_storage_client = remote_storage_client
+        # The DB, SSH and Drive connections are not thread safe. Local file
+        # writes can run concurrently, but calls to the shared clients are
+        # serialized when several persistence workers are used.
+        self._clients_lock = threading.Lock()
 
     def save_transcription(
         self,
         corpus_id: int,
         audio: Audio,
         segments: list[Segment],
-        audio_export_format: AudioFormat = AudioFormat.WAV,
+        audio_export_format: SegmentFormat = SegmentFormat.WAV,
         remote_storage_folder_id: Optional[str] = None,
+    ):
+        with METRICS.audio(audio.name):
+            return self._save_transcription(
+                corpus_id,
+                audio,
+                segments,
+                audio_export_format,
+                remote_storage_folder_id,
+            )
+
+    def _save_transcription(
+        self,
+        corpus_id: int,
+        audio: Audio,
+        segments: List[Segment],
+        audio_export_format: SegmentFormat,
+        remote_storage_folder_id: Optional[str],
     ):
         saved_segments = []
         logger.info(f"Persisting data for audio {audio.name} transcription")
-        audio_id_in_db = None
-        
-        for segment in segments:
-            try:
-                logger.debug("Saving to files")
-                saved_segment = self._save_transcription_to_file(
-                    audio, segment, audio_export_format.value
-                )
 
+        logger.debug("Saving to files")
+        with METRICS.span("write_files"):
+            saved_to_files = self._save_transcription_to_files(
+                audio, segments, audio_export_format
+            )
+        METRICS.add(
+            "written_bytes",
+            sum(os.path.getsize(s.segment_path) for s in saved_to_files if s is not None),
+        )
+
+        for segment, saved_segment in zip(segments, saved_to_files):
+            try:
                 if saved_segment is None:
                     logger.error(
                         f"Erro ao processar segmento {segment.segment_num} in {audio.name}",
@@ -60,25 +97,14 @@ class OutputPersistanceService:
                     )
                     continue
 
-                if self.db is not None:
-                    logger.debug("Saving to DB")
-                    audio_id_in_db = self._save_transcription_to_db(corpus_id, audio, saved_segment, audio_id_in_db)
-
-                if self.file_transfer_client is not None:
-                    logger.debug("Transfering to server")
-                    self.file_transfer_client.put(
-                        source=saved_segment.segment_path,
-                        target=os.path.join(
-                            CONFIG.remote.dataset_path, saved_segment.segment_path
-                        ),
-                    )
-                if self.remote_storage_client is not None:
-                    logger.debug("Saving to Google Drive")
-                    self._save_transcription_to_remote(
-                        remote_storage_folder_id, audio, saved_segment
-                    )
+                with self._clients_lock:
+                    if self.remote_storage_client is not None:
+                        logger.debug("Saving to Google Drive")
+                        self._save_transcription_to_remote(
+                            remote_storage_folder_id, audio, saved_segment
+                        )
 
-                saved_segments.append(saved_segment.dict())
+                saved_segments.append(saved_segment)
 
             except Exception as e:
                 logger.error(
@@ -87,19 +113,54 @@ class OutputPersistanceService:
                 )
                 return None
 
-        
-            df = pd.DataFrame(saved_segments)
-            df.to_csv(
-                self.output_folder / audio.name / "summary.csv",
-                index=False,
-                encoding="utf-8",
-                sep="|",
-                mode="w",
+        if not saved_segments:
+            logger.warning(f"No segments were saved for audio {audio.name}")
+            return None
+
+        if self.file_transfer_client is not None:
+            logger.debug("Transfering to server")
+            with self._clients_lock, METRICS.span("transfer"):
+                self.file_transfer_client.put_many(
+                    [
+                        (
+                            saved_segment.segment_path,
+                            os.path.join(
+                                CONFIG.remote.dataset_path, saved_segment.segment_path
+                            ),
+                        )
+                        for saved_segment in saved_segments
+                    ]
+                )
+            METRICS.add(
+                "transfer_bytes",
+                sum(os.path.getsize(s.segment_path) for s in saved_segments),
             )
 
-    def _save_transcription_to_file(
-        self, audio: Audio, segment: Segment, audio_export_format: str
-    ) -> Optional[SegmentCreate]:
+        if self.db is not None:
+            logger.debug("Saving to DB")
+            with self._clients_lock:
+                self._save_transcription_to_db(
+                    corpus_id, audio, saved_segments
+                )
+
+        df = pd.DataFrame([s.dict() for s in saved_segments])
+        df.to_csv(
+            self.output_folder / audio.name / "summary.csv",
+            index=False,
+            encoding="utf-8",
+            sep="|",
+            mode="w",
+        )
+
+    def _save_transcription_to_files(
+        self, audio: Audio, segments: List[Segment], audio_export_format: SegmentFormat
+    ) -> List[Optional[SegmentCreate]]:
+        """Writes the audio and text files of every segment.
+
+        The trimmed audio is taken once and each segment is written from a
+        numpy view of it, so no samples are copied. soundfile releases the GIL
+        while encoding, so the files can be written by a pool of threads.
+        """
         if self.output_folder is None:
             raise Exception(
                 "Output folder not provided. Cannot save transcription to file."
@@ -111,6 +172,29 @@ class OutputPersistanceService:
         for folder in (output_audio_folder, output_transcription_folder):
             folder.mkdir(parents=True, exist_ok=True)
 
+        save_segment = partial(
+            self._save_transcription_to_file,
+            audio,
+            audio.trimmed_audio,
+            audio_export_format.value,
+            output_audio_folder,
+            output_transcription_folder,
+        )
+        workers = CONFIG.pipeline.segment_writer_workers
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(save_segment, segments))
+        return [save_segment(segment) for segment in segments]
+
+    def _save_transcription_to_file(
+        self,
+        audio: Audio,
+        trimmed_audio: np.ndarray,
+        audio_export_format: str,
+        output_audio_folder: Path,
+        output_transcription_folder: Path,
+        segment: Segment,
+    ) -> Optional[SegmentCreate]:
         try:
             original_start_time = audio.start_offset_trimmed_audio + segment.start_time
             original_end_time = audio.start_offset_trimmed_audio + segment.end_time
@@ -128,9 +212,16 @@ class OutputPersistanceService:
                 output_audio_folder, f"{segment_name}.{audio_export_format}"
             )
 
-            sf.write(segment_path_on_local,audio.trimmed_audio[
+            sf_format, sf_subtype = SEGMENT_FORMATS[audio_export_format]
+            sf.write(
+                segment_path_on_local,
+                trimmed_audio[
                     int(segment.start_time * audio.sample_rate) : int(segment.end_time * audio.sample_rate)
-                ], audio.sample_rate )
+                ],
+                audio.sample_rate,
+                format=sf_format,
+                subtype=sf_subtype,
+            )
 
             segment_saved = SegmentCreate(
                 **segment.dict(),
@@ -152,19 +243,17 @@ class OutputPersistanceService:
             return None
 
     def _save_transcription_to_db(
-        self, corpus_id: int, audio: Audio, segment: SegmentCreate, audio_id_in_db: Optional[int] = None
+        self, corpus_id: int, audio: Audio, segments: List[SegmentCreate]
     ) -> int:
         if self.db is None:
             raise Exception(
                 "Database client not provided. Cannot save transcription to database."
             )
 
-        if audio_id_in_db is None:
-            logger.info(f"Creating audio {audio.name} on database")
-            audio_id_in_db = self.db.add_audio(audio.name, corpus_id, audio.duration)
-        segment_to_db = SegmentCreateInDB(**segment.dict(), audio_id=audio_id_in_db)
-        self.db.add_audio_segment(segment_to_db)
-        return audio_id_in_db
+        logger.info(f"Creating audio {audio.name} with {len(segments)} segments on database")
+        return self.db.add_audio_with_segments(
+            audio.name, corpus_id, audio.duration, segments
+        )
 
     def _save_transcription_to_remote(
         self,
@@ -177,7 +266,7 @@ class OutputPersistanceService:
                 "Remote storage client not provided. Cannot save transcription to remote storage."
             )
 
-        for ext, folder in (("wav", "audios"), ("txt", "texts")):
+        for ext, folder in ((segment.extension, "audios"), ("txt", "texts")):
             file_to_upload = FileToUpload(
                 name=os.path.join("transcriptions",audio.name, folder, segment.segment_name),
                 path=(self.output_folder / audio.name / folder / f"{segment.segment_name}.{ext}").as_posix(),
@@ -187,6 +276,7 @@ class OutputPersistanceService:
             if folder_parent_id is None:
                 folder_parent_id = audio.parent_folder_id
 
-            self.remote_storage_client.upload_file_to_folder(
+            # Queued in the background so persistence doesn't wait on Drive.
+            self.remote_storage_client.upload_manager.submit(
                 folder_parent_id, file_to_upload
             )
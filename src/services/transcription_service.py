@@ -4,79 +4,349 @@ from whisperx.types import (
     TranscriptionResult,
     AlignedTranscriptionResult,
 )
-from whisperx.asr import FasterWhisperPipeline
-from typing import Literal, List
+from whisperx.asr import FasterWhisperPipeline, WhisperModel
+from whisperx.audio import SAMPLE_RATE
+from whisperx.vad import merge_chunks
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Literal, List, NamedTuple, Optional, Tuple
+import os
+import time
+import ctranslate2
 import torch
 from io import BytesIO
 from pydub import AudioSegment
 import numpy as np
 
 from src.utils.logger import get_logger
+from src.utils.metrics import METRICS
 from src.config import CONFIG
 from src.models.audio import Audio
 from src.models.segment import Segment
 
 logger = get_logger(__name__)
 logger.setLevel("DEBUG")
+
+# Maximum length, in seconds, of the VAD chunks fed to whisper (whisperx's
+# default for `transcribe`).
+CHUNK_SIZE = 30
+
+
 class SegmentWithSpeaker(SingleAlignedSegment):
     speaker: str
 
 
+class ModelRegistry:
+    """
+    Process-wide LRU cache for the auxiliary models used after ASR (alignment
+    and diarization), keyed by model kind, language and device.
+    """
+
+    def __init__(self, max_models: int = 4):
+        self.max_models = max_models
+        self._models: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.stats: Dict[Hashable, Dict[str, float]] = {}
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        stats = self.stats.setdefault(
+            key, {"loads": 0, "reuses": 0, "load_seconds": 0.0}
+        )
+        if key in self._models:
+            self._models.move_to_end(key)
+            stats["reuses"] += 1
+            return self._models[key]
+
+        logger.info(f"Loading model {key}")
+        start = time.perf_counter()
+        model = loader()
+        elapsed = time.perf_counter() - start
+        stats["loads"] += 1
+        stats["load_seconds"] += elapsed
+        logger.info(f"Model {key} loaded in {elapsed:.2f}s")
+
+        self._models[key] = model
+        while len(self._models) > self.max_models:
+            evicted_key, _ = self._models.popitem(last=False)
+            logger.info(f"Evicting model {evicted_key} from cache")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        return model
+
+    def clear(self):
+        self._models.clear()
+
+    def report(self) -> str:
+        lines = [
+            f"{key}: loads={int(s['loads'])}, reuses={int(s['reuses'])}, load_time={s['load_seconds']:.2f}s"
+            for key, s in self.stats.items()
+        ]
+        return "\n".join(lines)
+
+
+MODEL_REGISTRY = ModelRegistry(max_models=CONFIG.computation.max_cached_models)
+
+
+class EngineSettings(NamedTuple):
+    device: Literal["cuda", "cpu"]
+    compute_type: str
+    cpu_threads: int
+    num_workers: int
+
+
+# Preferred CTranslate2 compute types, fastest first. float16 is not
+# supported (or emulated and slow) on CPU, where int8 is the fastest.
+PREFERRED_COMPUTE_TYPES = {
+    "cuda": ("float16", "int8_float16", "float32"),
+    "cpu": ("int8", "int8_float32", "float32"),
+}
+
+
+def available_cores() -> int:
+    # Cores this process may run on, which respects container CPU pinning.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def select_engine(
+    device: Optional[str] = None,
+    compute_type: Optional[str] = None,
+    cpu_threads: int = 0,
+    num_workers: int = 1,
+) -> EngineSettings:
+    """Resolves the CTranslate2 settings for this host.
+
+    The device defaults to CUDA when available. A compute type the device
+    doesn't support is replaced by the fastest one it does, and the CPU
+    threads default to the available cores split between the workers.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    supported = ctranslate2.get_supported_compute_types(device)
+
+    if compute_type is not None and compute_type not in supported:
+        logger.warning(
+            f"Compute type {compute_type} is not supported on {device}. Choosing another one."
+        )
+        compute_type = None
+    if compute_type is None:
+        compute_type = next(
+            (t for t in PREFERRED_COMPUTE_TYPES[device] if t in supported), "default"
+        )
+
+    num_workers = max(1, num_workers)
+    if cpu_threads <= 0:
+        cpu_threads = max(1, available_cores() // num_workers)
+
+    return EngineSettings(
+        device=device,  # type: ignore
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+
+
 class TranscriptionService:
     def __init__(
         self,
-        whisper_model: str = "large-v2",
-        batch_size: int = 8,
-        compute_type: str = "float16",
+        whisper_model: str = CONFIG.computation.whisper_model,
+        batch_size: int = CONFIG.computation.batch_size,
+        compute_type: Optional[str] = CONFIG.computation.compute_type,
+        device: Optional[str] = CONFIG.computation.device,
+        cpu_threads: int = CONFIG.computation.cpu_threads,
+        num_workers: int = CONFIG.computation.num_workers,
     ):
-        self.device: Literal["cuda", "cpu"] = (
-            "cuda" if torch.cuda.is_available() else "cpu"
+        self.engine = select_engine(device, compute_type, cpu_threads, num_workers)
+        self.device: Literal["cuda", "cpu"] = self.engine.device
+        logger.info(
+            f"Loading whisper model {whisper_model} on {self.device} with {self.engine.compute_type}"
+            + (f", {self.engine.cpu_threads} threads and {self.engine.num_workers} workers" if self.device == "cpu" else "")
+        )
+        model = WhisperModel(
+            whisper_model,
+            device=self.device,
+            compute_type=self.engine.compute_type,
+            cpu_threads=self.engine.cpu_threads,
+            num_workers=self.engine.num_workers,
         )
-        logger.info(f"Loading whisper model {whisper_model}")
         self.whisperx_model: FasterWhisperPipeline = whisperx.load_model(
-            whisper_model, self.device, compute_type=compute_type, language="pt"
+            whisper_model,
+            self.device,
+            compute_type=self.engine.compute_type,
+            language="pt",
+            model=model,
+            threads=self.engine.cpu_threads,
         )
         self.batch_size: int = batch_size
-        self.compute_type: str = compute_type
+        self.compute_type: str = self.engine.compute_type
+        self.models = MODEL_REGISTRY
+
+    def warmup(self, seconds: float = 1.0):
+        """Runs one chunk through the model so the first audio doesn't pay
+        for the lazy initialization of CTranslate2 (and of CUDA)."""
+        if self.whisperx_model.tokenizer is None:
+            return
+        start = time.perf_counter()
+        waveform = np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+        list(self.whisperx_model([{"inputs": waveform}], batch_size=1, num_workers=0))
+        logger.info(f"Whisper model warmed up in {time.perf_counter() - start:.2f}s")
+
+    def report(self) -> str:
+        """Real-time factors of the ASR and alignment+diarization stages, from
+        the run totals in METRICS."""
+        audio_seconds = METRICS.total("asr_audio_duration")
+        if not audio_seconds:
+            return "No audio transcribed"
+        recognize_seconds = METRICS.total("asr_seconds")
+        assign_seconds = METRICS.total("alignment_seconds") + METRICS.total(
+            "diarization_seconds"
+        )
+        total = recognize_seconds + assign_seconds
+        return (
+            f"{audio_seconds / 3600:.2f}h of audio on {self.device} ({self.compute_type}, batch_size={self.batch_size}): "
+            f"ASR RTF={recognize_seconds / audio_seconds:.3f}, "
+            f"alignment+diarization RTF={assign_seconds / audio_seconds:.3f}, "
+            f"total RTF={total / audio_seconds:.3f} ({audio_seconds / total if total else 0:.1f}x real time)"
+        )
+
+    def get_align_model(self, language_code: str) -> Tuple[Any, dict]:
+        return self.models.get(
+            ("align", language_code, self.device),
+            lambda: whisperx.load_align_model(
+                language_code=language_code, device=self.device
+            ),
+        )
+
+    def get_diarize_model(self) -> whisperx.DiarizationPipeline:
+        return self.models.get(
+            ("diarize", None, self.device),
+            lambda: whisperx.DiarizationPipeline(
+                use_auth_token=CONFIG.pyannote.auth_token, device=self.device
+            ),
+        )
 
     def transcribe(self, audio: Audio) -> List[Segment]:
+        return self.assign_segments(audio, self.recognize(audio))
+
+    def recognize(self, audio: Audio) -> TranscriptionResult:
         # TODO: evaluate if it is better to use a temporary file or not
         # logger.debug("Loading audio")
         # audio = whisperx.load_audio(audio_name)
 
         logger.debug("Transcribing audio")
-        transcription_result: TranscriptionResult = self.whisperx_model.transcribe(
+        start = time.perf_counter()
+        result = self.whisperx_model.transcribe(
             audio.trimmed_audio, batch_size=self.batch_size
         )
-
-        logger.debug("Aligning audio")
-        model_a, metadata = whisperx.load_align_model(
-            language_code=transcription_result["language"], device=self.device
+        elapsed = time.perf_counter() - start
+        METRICS.add("asr_seconds", elapsed, audio=audio.name)
+        METRICS.add(
+            "asr_audio_duration",
+            len(audio.trimmed_audio) / audio.sample_rate,
+            audio=audio.name,
         )
-        align_result: AlignedTranscriptionResult = whisperx.align(
-            transcription_result["segments"], #type: ignore
-            model_a,
-            metadata,
-            audio.trimmed_audio,
-            self.device,
-            return_char_alignments=False,
+        return result
+
+    def recognize_batch(self, audios: List[Audio]) -> List[TranscriptionResult]:
+        """Transcribes several audios sharing the model batches between them.
+
+        `FasterWhisperPipeline.transcribe` batches the VAD chunks of a single
+        audio, so short audios leave most of the batch empty. Here the VAD
+        chunks of every audio are fed to the model as one stream, so all
+        batches but the last are full, and the texts are scattered back to
+        the audio each chunk came from.
+        """
+        model = self.whisperx_model
+        if len(audios) == 1 or model.tokenizer is None:
+            # Without a preset language, whisperx detects it per audio.
+            return [self.recognize(audio) for audio in audios]
+
+        logger.debug(f"Detecting speech on {len(audios)} audios")
+        start = time.perf_counter()
+        chunks: List[Tuple[int, dict]] = []
+        for audio_idx, audio in enumerate(audios):
+            vad_segments = model.vad_model(
+                {
+                    "waveform": torch.from_numpy(audio.trimmed_audio).unsqueeze(0),
+                    "sample_rate": SAMPLE_RATE,
+                }
+            )
+            vad_segments = merge_chunks(
+                vad_segments,
+                CHUNK_SIZE,
+                onset=model._vad_params["vad_onset"],
+                offset=model._vad_params["vad_offset"],
+            )
+            chunks.extend((audio_idx, vad_segment) for vad_segment in vad_segments)
+
+        def chunks_audio():
+            for audio_idx, vad_segment in chunks:
+                yield {
+                    "inputs": audios[audio_idx].trimmed_audio[
+                        int(vad_segment["start"] * SAMPLE_RATE) : int(vad_segment["end"] * SAMPLE_RATE)
+                    ]
+                }
+
+        logger.debug(
+            f"Transcribing {len(chunks)} chunks of {len(audios)} audios in batches of {self.batch_size}"
         )
+        language = model.tokenizer.language_code
+        results: List[TranscriptionResult] = [
+            {"segments": [], "language": language} for _ in audios
+        ]
+        for (audio_idx, vad_segment), output in zip(
+            chunks, model(chunks_audio(), batch_size=self.batch_size, num_workers=0)
+        ):
+            text = output["text"]
+            if self.batch_size in (0, 1, None):
+                text = text[0]
+            results[audio_idx]["segments"].append(
+                {
+                    "text": text,
+                    "start": round(vad_segment["start"], 3),
+                    "end": round(vad_segment["end"], 3),
+                }
+            )
+        elapsed = time.perf_counter() - start
+        durations = [len(audio.trimmed_audio) / audio.sample_rate for audio in audios]
+        # The batches are shared, so the time is split by audio duration.
+        for audio, duration in zip(audios, durations):
+            METRICS.add(
+                "asr_seconds",
+                elapsed * duration / sum(durations) if sum(durations) else 0.0,
+                audio=audio.name,
+            )
+            METRICS.add("asr_audio_duration", duration, audio=audio.name)
+        return results
+
+    def assign_segments(
+        self, audio: Audio, transcription_result: TranscriptionResult
+    ) -> List[Segment]:
+        logger.debug("Aligning audio")
+        with METRICS.span("alignment", audio=audio.name):
+            model_a, metadata = self.get_align_model(transcription_result["language"])
+            align_result: AlignedTranscriptionResult = whisperx.align(
+                transcription_result["segments"], #type: ignore
+                model_a,
+                metadata,
+                audio.trimmed_audio,
+                self.device,
+                return_char_alignments=False,
+            )
 
         logger.debug("Diarization audio with PyAnnote")
         # 3. Assign speaker labels
-        diarize_model = whisperx.DiarizationPipeline(
-            use_auth_token=CONFIG.pyannote.auth_token, device=self.device
-        )
-        
-        dict_input = {"waveform": torch.from_numpy(np.array(audio.trimmed_audio)).unsqueeze(0),
-                   "sample_rate": audio.sample_rate,
-                   "channel": 0}
-        # # add min/max number of speakers if known
-        # diarize_segments = diarize_model(audio_file)
-        diarize_segments = diarize_model(dict_input, min_speakers=1, max_speakers=4
-        )
+        with METRICS.span("diarization", audio=audio.name):
+            diarize_model = self.get_diarize_model()
+
+            dict_input = {"waveform": torch.from_numpy(np.array(audio.trimmed_audio)).unsqueeze(0),
+                       "sample_rate": audio.sample_rate,
+                       "channel": 0}
+            # # add min/max number of speakers if known
+            # diarize_segments = diarize_model(audio_file)
+            diarize_segments = diarize_model(dict_input, min_speakers=1, max_speakers=4
+            )
 
-        result = whisperx.assign_word_speakers(diarize_segments, align_result)
+            result = whisperx.assign_word_speakers(diarize_segments, align_result)
         resulted_segments: List[SegmentWithSpeaker] = result["segments"]
         segments = [
             Segment(
@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+
+class ExportManifest:
+    """
+    SQLite record of the artifacts written to an export folder. Each artifact
+    of an audio is stored with the fingerprint of the data it was built from
+    (see `Database.get_segment_fingerprints`), so a rerun only regenerates the
+    artifacts whose fingerprint changed or that were never exported.
+    """
+
+    def __init__(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    corpus_id INTEGER NOT NULL,
+                    audio_id INTEGER NOT NULL,
+                    artifact TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    PRIMARY KEY (corpus_id, audio_id, artifact)
+                )
+                """
+            )
+
+    def get_artifacts(self, corpus_id: int) -> Dict[Tuple[int, str], str]:
+        """Returns the fingerprint of every exported artifact of the corpus,
+        keyed by (audio_id, artifact)."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT audio_id, artifact, fingerprint FROM artifacts WHERE corpus_id = ?",
+                (corpus_id,),
+            ).fetchall()
+        return {(audio_id, artifact): fingerprint for audio_id, artifact, fingerprint in rows}
+
+    def add_artifacts(
+        self, corpus_id: int, audio_id: int, artifacts: Iterable[str], fingerprint: str
+    ):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO artifacts (corpus_id, audio_id, artifact, fingerprint) VALUES (?, ?, ?, ?)",
+                [
+                    (corpus_id, int(audio_id), artifact, fingerprint)
+                    for artifact in artifacts
+                ],
+            )
+
+    def remove_audios(self, corpus_id: int, audio_ids: Iterable[int]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM artifacts WHERE corpus_id = ? AND audio_id = ?",
+                [(corpus_id, int(audio_id)) for audio_id in audio_ids],
+            )
+
+    def clear(self, corpus_id: int):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM artifacts WHERE corpus_id = ?", (corpus_id,)
+            )
+
+    def close(self):
+        self._connection.close()
@@ -6,6 +6,8 @@ def get_mime_from_extension(extension) -> Optional[str]:
         mime = {
             "wav": "audio/wav",
             "mp3": "audio/mp3",
+            "flac": "audio/flac",
+            "opus": "audio/ogg",
             "mp4": "video/mp4",
             "txt": "text/plain",
             "doc": "application/vnd.google-apps.document",
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class Metrics:
+    """
+    Thread-safe timers and counters for the pipeline stages.
+
+    Values are added to the run totals and, when there is one, to the audio
+    being processed. The current audio is per thread and set with
+    `with METRICS.audio(name)`, so the clients and services only open spans
+    (`with METRICS.span("download")`) or add counters
+    (`METRICS.add("download_bytes", n)`) without knowing which audio they
+    work for. Span times are stored as `<stage>_seconds`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._totals: Dict[str, float] = defaultdict(float)
+        self._audios: Dict[str, Dict[str, float]] = {}
+
+    def current_audio(self) -> Optional[str]:
+        return getattr(self._local, "audio", None)
+
+    @contextmanager
+    def audio(self, name: Optional[str]) -> Iterator[None]:
+        previous = self.current_audio()
+        self._local.audio = name
+        try:
+            yield
+        finally:
+            self._local.audio = previous
+
+    @contextmanager
+    def span(self, stage: str, audio: Optional[str] = None) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{stage}_seconds", time.perf_counter() - start, audio)
+
+    def add(self, name: str, value: float, audio: Optional[str] = None):
+        audio = audio or self.current_audio()
+        with self._lock:
+            self._totals[name] += value
+            if audio is not None:
+                row = self._audios.setdefault(audio, defaultdict(float))
+                row[name] += value
+
+    def total(self, name: str) -> float:
+        with self._lock:
+            return self._totals.get(name, 0.0)
+
+    def set(self, name: str, value: float, audio: Optional[str] = None):
+        """Sets a per-audio value that is not summed, like its duration."""
+        audio = audio or self.current_audio()
+        if audio is None:
+            return
+        with self._lock:
+            self._audios.setdefault(audio, defaultdict(float))[name] = value
+
+    @staticmethod
+    def _with_rtf(values: Dict[str, float]) -> Dict[str, float]:
+        seconds = sum(v for k, v in values.items() if k.endswith("_seconds"))
+        audio_seconds = values.get("audio_duration", 0.0)
+        return {
+            **values,
+            "total_seconds": seconds,
+            "rtf": seconds / audio_seconds if audio_seconds else None,
+        }
+
+    def rows(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"audio": audio, **self._with_rtf(dict(values))}
+                for audio, values in self._audios.items()
+            ]
+
+    def write(self, path: Path, run_id: str):
+        """Appends one row per audio to `path`, as Parquet if it ends in
+        `.parquet` and as JSON lines otherwise."""
+        if Path(path).suffix == ".parquet":
+            self.write_parquet(path, run_id)
+        else:
+            self.write_jsonl(path, run_id)
+
+    def write_parquet(self, path: Path, run_id: str):
+        """Appends one row per audio to a Parquet file.
+
+        Parquet files can't be appended to, so the rows of the previous runs
+        are read and the file is replaced with a new one.
+        """
+        rows = [{"run_id": run_id, **row} for row in self.rows()]
+        if not rows:
+            return
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pylist(rows)
+        if path.exists():
+            table = pa.concat_tables(
+                [pq.read_table(path), table], promote_options="default"
+            )
+        temp_path = path.with_name(f".{path.name}.part")
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+
+    def write_jsonl(self, path: Path, run_id: str):
+        """Appends one row per audio to a JSON lines file."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for row in self.rows():
+                f.write(json.dumps({"run_id": run_id, **row}) + "\n")
+
+    def summary(self) -> str:
+        with self._lock:
+            totals = dict(self._totals)
+            audio_seconds = sum(
+                values.get("audio_duration", 0.0) for values in self._audios.values()
+            )
+        stages = sorted(
+            ((k, v) for k, v in totals.items() if k.endswith("_seconds")),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        stage_seconds = sum(v for _, v in stages)
+        lines = [
+            f"{len(self._audios)} audios, {audio_seconds / 3600:.2f}h of audio, "
+            f"{stage_seconds / 3600:.2f}h in stages"
+            + (f" (RTF {stage_seconds / audio_seconds:.3f})" if audio_seconds else "")
+        ]
+        lines += [
+            f"  {name[: -len('_seconds')]}: {seconds:.1f}s ({100 * seconds / stage_seconds:.1f}%)"
+            for name, seconds in stages
+        ]
+        lines += [
+            f"  {name}: {value / 1024**2:.1f}MB" if name.endswith("_bytes") else f"  {name}: {value:g}"
+            for name, value in sorted(totals.items())
+            if not name.endswith("_seconds")
+        ]
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+            self._audios.clear()
+
+
+METRICS = Metrics()
@@ -0,0 +1,38 @@
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Iterable
+
+
+class PrefixIndex:
+    """
+    Sorted in-memory index of names that answers "is there any name starting
+    with this prefix?" in O(log n), mirroring a `LIKE 'prefix%'` query.
+
+    Matching ignores case and accents, like the default (`_ci`) MySQL
+    collations.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self._names = sorted({self._normalize(name) for name in names})
+
+    @staticmethod
+    def _normalize(name: str) -> str:
+        decomposed = unicodedata.normalize("NFKD", name.casefold())
+        return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, name: str):
+        """Records a name, e.g. an audio scheduled during the run."""
+        name = self._normalize(name)
+        position = bisect_left(self._names, name)
+        if position == len(self._names) or self._names[position] != name:
+            insort(self._names, name, lo=position)
+
+    def has_prefix(self, prefix: str) -> bool:
+        prefix = self._normalize(prefix)
+        position = bisect_left(self._names, prefix)
+        return position < len(self._names) and self._names[position].startswith(
+            prefix
+        )
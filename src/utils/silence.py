@@ -0,0 +1,89 @@
+from typing import NamedTuple
+
+import numpy as np
+
+
+# Energies below this are treated as silence, like librosa's `amin` for
+# amplitude_to_db (1e-5 ** 2).
+MIN_POWER = 1e-10
+
+
+class TrimResult(NamedTuple):
+    non_silent_interval: np.ndarray
+    peak: float
+    rms: float
+
+
+def _block_energies(y: np.ndarray, hop_length: int) -> np.ndarray:
+    """Sum of squares of every `hop_length` block of the last axis.
+
+    The full blocks are reduced through a reshaped (strided) view of the
+    signal, so the samples are never copied; only the last partial block is.
+    """
+    n_samples = y.shape[-1]
+    n_full = n_samples // hop_length
+    blocks = y[..., : n_full * hop_length].reshape(y.shape[:-1] + (n_full, hop_length))
+    energies = np.einsum("...ij,...ij->...i", blocks, blocks, dtype=np.float64)
+
+    tail = y[..., n_full * hop_length :]
+    if tail.shape[-1]:
+        tail_energy = np.einsum("...j,...j->...", tail, tail, dtype=np.float64)
+        energies = np.concatenate([energies, tail_energy[..., None]], axis=-1)
+    return energies
+
+
+def trim_silence(
+    y: np.ndarray,
+    top_db: float = 20,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> TrimResult:
+    """Finds the non silent interval of `y`, like `librosa.effects.trim`.
+
+    librosa computes the RMS of centered, zero padded frames and keeps the
+    frames within `top_db` of the loudest one. A frame is `frame_length /
+    hop_length` consecutive blocks of `hop_length` samples, so here the energy
+    of each block is computed once and the frame energies are sums of shifted
+    block energies, without building the frames or padding the signal. The
+    first and last non silent frames are then found scanning inward from
+    both ends, and the peak and RMS of the whole signal come from the same
+    reductions.
+
+    `y` is (samples,) or (channels, samples); a frame is non silent if any
+    channel is.
+    """
+    if frame_length % (2 * hop_length) != 0:
+        raise ValueError("frame_length must be a multiple of 2 * hop_length")
+
+    n_samples = y.shape[-1]
+    blocks_per_frame = frame_length // hop_length
+    n_frames = 1 + n_samples // hop_length
+
+    block_energies = _block_energies(y, hop_length)
+    # Centered frames start half a frame before their hop, which is the zero
+    # padding on the left; pad the right up to the last frame.
+    padded = np.zeros(y.shape[:-1] + (n_frames + blocks_per_frame - 1,))
+    left = blocks_per_frame // 2
+    padded[..., left : left + block_energies.shape[-1]] = block_energies
+    frame_power = sum(
+        padded[..., i : i + n_frames] for i in range(blocks_per_frame)
+    ) / frame_length
+
+    threshold = max(MIN_POWER, frame_power.max()) * 10.0 ** (-top_db / 10.0)
+    non_silent = np.maximum(MIN_POWER, frame_power) > threshold
+    if non_silent.ndim > 1:
+        non_silent = non_silent.any(axis=tuple(range(non_silent.ndim - 1)))
+
+    # argmax stops at the first True, scanning inward from each end.
+    if non_silent.any():
+        first = int(np.argmax(non_silent))
+        last = n_frames - 1 - int(np.argmax(non_silent[::-1]))
+        interval = np.asarray(
+            [first * hop_length, min(n_samples, (last + 1) * hop_length)]
+        )
+    else:
+        interval = np.asarray([0, 0])
+
+    peak = max(float(y.max()), -float(y.min())) if n_samples else 0.0
+    rms = float(np.sqrt(block_energies.sum() / y.size)) if n_samples else 0.0
+    return TrimResult(non_silent_interval=interval, peak=peak, rms=rms)